@@ -4,13 +4,17 @@ import json
 import yaml
 import logging
 import logging.config
-from pykafka import KafkaClient
 from pykafka.common import OffsetType
+from pykafka.exceptions import SocketDisconnectedError
+from pykafka.protocol import PartitionFetchRequest
+from event_index import EventIndex
+from kafka_pool import KafkaPool, KafkaUnavailable
 from threading import Thread
 from connexion import FlaskApp
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 import os
+import time
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -33,78 +37,207 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+# Ordinal to (partition, offset) index of each event type, built by tail_events
+INDEX_DIR = app_config["datastore"]["index_dir"]
+event_index = EventIndex(INDEX_DIR)
+logger.info(f"Loaded event index {event_index.stats()['events']} from {INDEX_DIR}")
+
+# One Kafka client for the whole process, shared by the index consumer and every lookup
+pool_config = app_config['events']['pool']
+kafka = KafkaPool(f"{app_config['events']['hostname']}:{app_config['events']['port']}",
+                  app_config['events']['topic'],
+                  backoff_sec=pool_config['backoff_sec'],
+                  max_backoff_sec=pool_config['max_backoff_sec'],
+                  health_check_sec=pool_config['health_check_sec'])
+
+def connect_index_consumer():
+    """ Returns the events topic and a consumer positioned after the last indexed offsets, waiting for Kafka """
+    while True:
+        try:
+            events = kafka.get_topic()
+            consumer = events.get_simple_consumer(auto_offset_reset=OffsetType.EARLIEST,
+                                                  reset_offset_on_start=True,
+                                                  consumer_timeout_ms=app_config['index']['flush_ms'])
+            if event_index.offsets:
+                # The index holds the last consumed offset, which is what reset_offsets expects
+                consumer.reset_offsets([(events.partitions[partition_id], offset)
+                                        for partition_id, offset in event_index.offsets.items()
+                                        if partition_id in events.partitions])
+            return events, consumer
+        except KafkaUnavailable:
+            # The client backs off between connects, so polling it often costs nothing
+            time.sleep(1)
+        except Exception as e:
+            kafka.invalidate(e)
+            time.sleep(1)
+
+def tail_events():
+    """ Consumes the events topic from where the saved index left off, indexing every event
+
+    Undecodable messages are indexed under no type. Any other error drops the shared client and
+    resumes from the offsets indexed so far, so the index never stops growing while the service is up.
+    """
+    index_config = app_config['index']
+
+    while True:
+        events, consumer = connect_index_consumer()
+        logger.info(f"Indexing {app_config['events']['topic']} from offsets {event_index.offsets or consumer.held_offsets}")
+        try:
+            last_save = time.time()
+            while True:
+                num_messages = 0
+                deadline = time.time() + index_config['flush_ms'] / 1000
+                while num_messages < index_config['batch_size'] and time.time() < deadline:
+                    msg = consumer.consume(block=True)
+                    if msg is None:
+                        break
+                    num_messages += 1
+                    try:
+                        event_type = json.loads(msg.value.decode('utf-8'))['type']
+                    except (ValueError, KeyError, TypeError) as e:
+                        logger.error(f"Failed to decode message at offset {msg.offset}: {e}")
+                        event_type = None
+                    event_index.add(event_type, msg.partition_id, msg.offset)
+
+                if time.time() - last_save >= index_config['snapshot_sec']:
+                    try:
+                        latest = events.latest_available_offsets()
+                        event_index.latest_offsets = {partition_id: response.offset[0] for partition_id, response in latest.items()}
+                    except Exception as e:
+                        logger.warning(f"Failed to fetch the latest offsets: {e}")
+                    event_index.save()
+                    last_save = time.time()
+        except Exception as e:
+            logger.exception(f"Indexing {app_config['events']['topic']} failed, reconnecting: {e}")
+            kafka.invalidate(e)
+            try:
+                consumer.stop()
+            except Exception:
+                pass
+            time.sleep(1)
+
+def fetch_events(locations):
+    """ Fetches the payloads of the messages at [(partition id, offset)] straight from the partition leaders
+
+    Each round is one request per leader, covering every partition that still has offsets to reach,
+    so a slice of history costs a few bounded fetches however the events are spread. Returns
+    {(partition id, offset): payload} for every message still on the topic. Raises KafkaUnavailable
+    if Kafka cannot be reached, dropping the shared client when a fetch fails.
+    """
+    if not locations:
+        # An empty range is answered from the index alone, even while Kafka is down
+        return {}
+    index_config = app_config['index']
+    topic = kafka.get_topic()
+    wanted = {}
+    for partition_id, offset in locations:
+        wanted.setdefault(partition_id, set()).add(offset)
+    next_offsets = {partition_id: min(offsets) for partition_id, offsets in wanted.items()}
+    payloads = {}
+
+    while next_offsets:
+        requests_by_leader = {}
+        for partition_id, offset in next_offsets.items():
+            requests_by_leader.setdefault(topic.partitions[partition_id].leader, []).append(
+                PartitionFetchRequest(topic.name, partition_id, offset, index_config['fetch_max_bytes']))
+
+        for leader, requests in requests_by_leader.items():
+            try:
+                response = leader.fetch_messages(requests, timeout=index_config['fetch_timeout_ms'], min_bytes=1)
+            except (IOError, SocketDisconnectedError) as e:
+                kafka.invalidate(e)
+                raise KafkaUnavailable(f"Failed to fetch from Kafka: {e}") from e
+            for request in requests:
+                partition_id = request.partition_id
+                messages = response.topics[topic.name][partition_id].messages
+                for msg in messages:
+                    if msg.offset in wanted[partition_id]:
+                        payloads[(partition_id, msg.offset)] = json.loads(msg.value.decode('utf-8'))["payload"]
+                # Nothing returned means the offset is gone from the topic, stop rather than ask again
+                next_offset = max((msg.offset + 1 for msg in messages), default=None)
+                if next_offset is None or next_offset > max(wanted[partition_id]):
+                    del next_offsets[partition_id]
+                else:
+                    next_offsets[partition_id] = next_offset
+    return payloads
+
+def get_event(event_type, index):
+    """ Gets the event of event_type at index in history, negative indexes counting back from the newest """
+    start = time.perf_counter()
+    location = event_index.locate(event_type, index)
+    try:
+        payload = fetch_events([location]).get(location) if location is not None else None
+    except KafkaUnavailable as e:
+        return {"message": str(e)}, 503
+    event_index.record_lookup(time.perf_counter() - start, found=payload is not None)
+
+    if payload is None:
+        logger.error("Could not find %s event at index %d" % (event_type, index))
+        return {"message": "Not Found"}, 404
+    return payload, 200
+
 def get_parking_status(index):
     """Get Parking Status Event in History"""
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    
     logger.info("Retrieving parking status event at index %d" % index)
-
-    list_of_events = []
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            
-            if msg['type'] == 'parking_status':
-                list_of_events.append(msg["payload"])
-            
-        payload = list_of_events[index]
-        return payload, 200
-    except:
-        logger.error("No more messages found")
-    logger.error("Could not find parking status event at index %d" % index)
-    return {"message": "Not Found"}, 404
+    return get_event("parking_status", index)
 
 def get_payment_events(index):
     """Get Payment Event in History"""
-    hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
     logger.info("Retrieving payment event at index %d" % index)
+    return get_event("payment", index)
 
-    list_of_events = []
+def get_event_range(event_type, start, count):
+    """ Gets up to count consecutive events of event_type from start, or the latest count when start is None
+
+    Negative starts count back from the newest event.
+    """
+    count = min(count, app_config['index']['max_range_count'])
+    if start is None:
+        start = -count
+    begin = time.perf_counter()
+    first, locations, total = event_index.locate_range(event_type, start, count)
     try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            
-            if msg['type'] == 'payment':
-                list_of_events.append(msg["payload"])
-            
-        payload = list_of_events[index]
-        return payload, 200
-    except:
-        logger.error("No more messages found")
-    logger.error("Could not find payment event at index %d" % index)
-    return {"message": "Not Found"}, 404
+        payloads = fetch_events(locations)
+    except KafkaUnavailable as e:
+        return {"message": str(e)}, 503
+    event_index.record_lookup(time.perf_counter() - begin, found=len(payloads) == len(locations))
 
-def get_event_stats():
-    """Get Event Stats"""
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
+    logger.info(f"Retrieved {len(payloads)} {event_type} events from index {first}")
+    return {"start": first,
+            "total": total,
+            "events": [payloads[location] for location in locations if location in payloads]}, 200
 
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    num_parking_events = 0
-    num_payment_events = 0
+def get_parking_status_range(start, count=10):
+    """Get a Range of Parking Status Events in History"""
+    return get_event_range("parking_status", start, count)
 
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode("utf-8")
-            msg = json.loads(msg_str)
-            if msg["type"] == "parking_status":
-                num_parking_events += 1
-            elif msg["type"] == "payment":
-                num_payment_events += 1
-        return {"num_parking_events": num_parking_events, "num_payment_events": num_payment_events}, 200
-    except Exception as e:
-        logger.error("Error retrieving event stats: %s", str(e))
-    return {"message": "Error retrieving stats"}, 500
+def get_payment_range(start, count=10):
+    """Get a Range of Payment Events in History"""
+    return get_event_range("payment", start, count)
+
+def get_latest_parking_status(count=10):
+    """Get the Latest Parking Status Events"""
+    return get_event_range("parking_status", None, count)
+
+def get_latest_payment_events(count=10):
+    """Get the Latest Payment Events"""
+    return get_event_range("payment", None, count)
+
+def get_metrics():
+    """Get Event Index and Kafka Client Metrics"""
+    return {"index": event_index.stats(), "kafka": kafka.stats()}, 200
+
+def get_event_stats():
+    """Get Event Stats
+
+    The counts are the sizes of the event index, so they are answered from memory. lag is
+    the number of messages the index has yet to reach, as of its last check of the topic.
+    """
+    counts = event_index.counts()
+    lag = event_index.lag()
+    return {"num_parking_events": counts["parking_status"],
+            "num_payment_events": counts["payment"],
+            "lag": sum(lag.values()) if lag else None}, 200
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
@@ -124,4 +257,5 @@ if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     )
 
 if __name__ == "__main__":
+    Thread(target=tail_events, name='kafka-index', daemon=True).start()
     app.run(port=8110, host="0.0.0.0")
@@ -0,0 +1,174 @@
+import json
+import os
+import struct
+from array import array
+from threading import Lock
+
+# partition id, offset of one event
+RECORD = struct.Struct(">iq")
+EVENT_TYPES = ("parking_status", "payment")
+
+
+class OffsetIndex:
+    """ Partition and offset of every event of one type, in the order they were consumed
+
+    The ordinal of an event is its position in the arrays, so a lookup is two array reads.
+    Records are appended to an index file as they are flushed and never rewritten.
+    """
+
+    def __init__(self, path):
+        """ Initializes an empty index backed by the file at path """
+        self.path = path
+        self.partitions = array('i')
+        self.offsets = array('q')
+        self.num_flushed = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, partition_id, offset):
+        """ Appends the position of the next event """
+        self.partitions.append(partition_id)
+        self.offsets.append(offset)
+
+    def locate(self, ordinal):
+        """ Returns (partition id, offset) of the event at ordinal, negative ordinals counting from the newest """
+        return self.partitions[ordinal], self.offsets[ordinal]
+
+    def nbytes(self):
+        """ Returns the memory held by the arrays """
+        return len(self.partitions) * self.partitions.itemsize + len(self.offsets) * self.offsets.itemsize
+
+    def flush(self):
+        """ Appends the records added since the last flush to the index file and syncs it """
+        if self.num_flushed == len(self):
+            return
+        with open(self.path, 'ab') as f:
+            f.write(b"".join(RECORD.pack(self.partitions[i], self.offsets[i]) for i in range(self.num_flushed, len(self))))
+            f.flush()
+            os.fsync(f.fileno())
+        self.num_flushed = len(self)
+
+    def load(self, count):
+        """ Reads the first count records of the index file, dropping any written after the last saved positions """
+        if not os.path.isfile(self.path):
+            count = 0
+        else:
+            with open(self.path, 'r+b') as f:
+                data = f.read(count * RECORD.size)
+                count = len(data) // RECORD.size
+                f.truncate(count * RECORD.size)
+            for partition_id, offset in RECORD.iter_unpack(data[:count * RECORD.size]):
+                self.append(partition_id, offset)
+        self.num_flushed = count
+
+
+class EventIndex:
+    """ Ordinal to (partition, offset) indexes of the events topic, one per event type
+
+    The indexes are built by a single tail consumer and read by request threads. The arrays
+    only grow, and an ordinal is only served once it is below the length read under
+    the lock, so lookups never see a half-appended record.
+
+    Persistence is two-phase: the index files are flushed first, then positions.json is
+    atomically replaced with the consumed offsets and the number of records of each type.
+    On load every index is cut back to the count in positions.json, so a crash between
+    the two phases only loses events that are consumed again from the saved offsets.
+    """
+
+    def __init__(self, directory):
+        """ Loads the indexes and consumed offsets saved in directory, or starts empty """
+        self.positions_file = os.path.join(directory, "positions.json")
+        self.indexes = {event_type: OffsetIndex(os.path.join(directory, f"{event_type}.idx")) for event_type in EVENT_TYPES}
+        # Last consumed offset per partition
+        self.offsets = {}
+        # Log end offset per partition, as last seen by the tail consumer
+        self.latest_offsets = {}
+        self.lock = Lock()
+        self.metrics = {'lookups': 0, 'lookup_misses': 0, 'last_lookup_ms': 0.0, 'max_lookup_ms': 0.0, 'total_lookup_ms': 0.0}
+
+        counts = {}
+        if os.path.isfile(self.positions_file):
+            with open(self.positions_file, 'r') as f:
+                positions = json.load(f)
+            self.offsets = {int(partition_id): offset for partition_id, offset in positions['offsets'].items()}
+            counts = positions['counts']
+        for event_type, index in self.indexes.items():
+            index.load(counts.get(event_type, 0))
+
+    def add(self, event_type, partition_id, offset):
+        """ Records a consumed message, indexing it if it is an event of a known type """
+        with self.lock:
+            if event_type in self.indexes:
+                self.indexes[event_type].append(partition_id, offset)
+            self.offsets[partition_id] = offset
+
+    def counts(self):
+        """ Returns the number of events of each type indexed so far """
+        with self.lock:
+            return {event_type: len(index) for event_type, index in self.indexes.items()}
+
+    def locate(self, event_type, ordinal):
+        """ Returns (partition id, offset) of the event at ordinal, or None if there is no such event yet """
+        with self.lock:
+            index = self.indexes[event_type]
+            if not -len(index) <= ordinal < len(index):
+                return None
+            return index.locate(ordinal)
+
+    def locate_range(self, event_type, start, count):
+        """ Returns (first ordinal, [(partition id, offset)], events indexed) for up to count events from start
+
+        A negative start counts back from the newest event, so start=-count is the latest count events.
+        """
+        with self.lock:
+            index = self.indexes[event_type]
+            total = len(index)
+            first = max(total + start, 0) if start < 0 else min(start, total)
+            last = min(first + count, total)
+            return first, list(zip(index.partitions[first:last], index.offsets[first:last])), total
+
+    def record_lookup(self, elapsed_sec, found):
+        """ Records the latency of one lookup """
+        elapsed_ms = elapsed_sec * 1000
+        with self.lock:
+            self.metrics['lookups'] += 1
+            self.metrics['lookup_misses'] += not found
+            self.metrics['last_lookup_ms'] = round(elapsed_ms, 3)
+            self.metrics['max_lookup_ms'] = round(max(self.metrics['max_lookup_ms'], elapsed_ms), 3)
+            self.metrics['total_lookup_ms'] += elapsed_ms
+
+    def lag(self):
+        """ Returns the number of messages on the topic not yet consumed, per partition """
+        with self.lock:
+            return {partition_id: max(latest - self.offsets.get(partition_id, -1) - 1, 0)
+                    for partition_id, latest in self.latest_offsets.items()}
+
+    def save(self):
+        """ Flushes the indexes, then atomically replaces the saved positions """
+        with self.lock:
+            offsets = dict(self.offsets)
+            counts = {event_type: len(index) for event_type, index in self.indexes.items()}
+        # Only the tail consumer appends, and it is the caller, so nothing is added while flushing
+        for index in self.indexes.values():
+            index.flush()
+        with open(self.positions_file + ".tmp", 'w') as f:
+            json.dump({'offsets': offsets, 'counts': counts}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.positions_file + ".tmp", self.positions_file)
+
+    def stats(self):
+        """ Returns the index sizes, build progress and lookup latency """
+        lag = self.lag()
+        stats = {'events': self.counts()}
+        with self.lock:
+            stats.update(self.metrics)
+            stats['index_bytes'] = sum(index.nbytes() for index in self.indexes.values())
+            stats['offsets'] = {str(partition_id): offset for partition_id, offset in self.offsets.items()}
+        # Unknown until the tail consumer has checked the end of the topic
+        stats['lag'] = sum(lag.values()) if lag else None
+        stats['caught_up'] = stats['lag'] == 0
+        total_lookup_ms = stats.pop('total_lookup_ms')
+        stats['avg_lookup_ms'] = round(total_lookup_ms / stats['lookups'], 3) if stats['lookups'] else 0.0
+        return stats
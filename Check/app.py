@@ -1,6 +1,5 @@
 import connexion
 from connexion import NoContent
-import requests
 from requests.exceptions import Timeout, ConnectionError
 import yaml
 import json
@@ -9,6 +8,7 @@ import logging.config
 from apscheduler.schedulers.background import BackgroundScheduler
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
+from upstream import Upstream
 import os
 
 # Environment-specific configuration files
@@ -45,66 +45,56 @@ if not os.path.isfile(STATUS_FILE):
     with open(STATUS_FILE, 'w') as f:
         json.dump({}, f)
 
+def describe_receiver(response):
+    return "Healthy"
+
+def describe_storage(response):
+    storage_json = response.json()
+    return f"Storage has {storage_json['num_parking_events']} parking and {storage_json['num_payment_events']} payment events"
+
+def describe_processing(response):
+    processing_json = response.json()
+    return f"Processing has {processing_json['num_parking_events']} parking and {processing_json['num_payment_events']} payment events"
+
+def describe_analyzer(response):
+    analyzer_json = response.json()
+    return f"Analyzer has {analyzer_json['parking']} parking and {analyzer_json['payment']} payment events"
+
+SERVICES = {
+    "receiver": (RECEIVER_URL, describe_receiver),
+    "storage": (STORAGE_URL, describe_storage),
+    "processing": (PROCESSING_URL, describe_processing),
+    "analyzer": (ANALYZER_URL, describe_analyzer)
+}
+
+upstream = Upstream(TIMEOUT,
+                    retries=app_config["services"]["retries"],
+                    backoff_sec=app_config["services"]["backoff_sec"],
+                    max_workers=len(SERVICES))
+
 def check_services():
     """Periodically check the status of services and update the status.json file"""
     logger.info("Periodic service check started...")
 
-    status = {}
+    # Every service is probed at once, so the check takes as long as the slowest one
+    responses = upstream.get_all({name: url for name, (url, _) in SERVICES.items()})
 
-    # Receiver Service
-    receiver_status = "Unavailable"
-    try:
-        response = requests.get(RECEIVER_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            receiver_status = "Healthy"
-            logger.info("Receiver is Healthy")
-        else:
-            logger.info("Receiver returned non-200 response")
-    except (Timeout, ConnectionError):
-        logger.info("Receiver is Not Available")
-    status["receiver"] = receiver_status
-
-    # Storage Service
-    storage_status = "Unavailable"
-    try:
-        response = requests.get(STORAGE_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            storage_json = response.json()
-            storage_status = f"Storage has {storage_json['num_parking_events']} parking and {storage_json['num_payment_events']} payment events"
-            logger.info("Storage is Healthy")
-        else:
-            logger.info("Storage returned non-200 response")
-    except (Timeout, ConnectionError):
-        logger.info("Storage is Not Available")
-    status["storage"] = storage_status
-
-    # Processing Service
-    processing_status = "Unavailable"
-    try:
-        response = requests.get(PROCESSING_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            processing_json = response.json()
-            processing_status = f"Processing has {processing_json['num_parking_events']} parking and {processing_json['num_payment_events']} payment events"
-            logger.info("Processing is Healthy")
-        else:
-            logger.info("Processing returned non-200 response")
-    except (Timeout, ConnectionError):
-        logger.info("Processing is Not Available")
-    status["processing"] = processing_status
-
-    # Analyzer Service
-    analyzer_status = "Unavailable"
-    try:
-        response = requests.get(ANALYZER_URL, timeout=TIMEOUT)
-        if response.status_code == 200:
-            analyzer_json = response.json()
-            analyzer_status = f"Analyzer has {analyzer_json['parking']} parking and {analyzer_json['payment']} payment events"
-            logger.info("Analyzer is Healthy")
+    status = {}
+    for name, (_, describe) in SERVICES.items():
+        response = responses[name]
+        status[name] = "Unavailable"
+        if isinstance(response, (Timeout, ConnectionError)):
+            logger.info(f"{name.capitalize()} is Not Available")
+        elif isinstance(response, Exception):
+            logger.error(f"{name.capitalize()} check failed: {response}")
+        elif response.status_code != 200:
+            logger.info(f"{name.capitalize()} returned non-200 response")
         else:
-            logger.info("Analyzer returned non-200 response")
-    except (Timeout, ConnectionError):
-        logger.info("Analyzer is Not Available")
-    status["analyzer"] = analyzer_status
+            status[name] = describe(response)
+            logger.info(f"{name.capitalize()} is Healthy")
+
+    latency = upstream.stats()
+    status["latency_ms"] = {name: latency[name]['last_ms'] for name in SERVICES if name in latency}
 
     # Write status to file
     with open(STATUS_FILE, 'w') as f:
@@ -0,0 +1,86 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+logger = logging.getLogger('basicLogger')
+
+
+class Upstream:
+    """ Keep-alive HTTP client for the services polled by this one
+
+    Calls share one requests.Session, so connections to each host are reused instead of
+    opened per call. get_all fans calls out over a thread pool, so a cycle takes as long
+    as its slowest call rather than the sum of them all. Connection errors, timeouts
+    and 5xx responses are retried with full-jitter exponential backoff.
+    """
+
+    def __init__(self, timeout, retries, backoff_sec, max_workers):
+        """ Initializes the session, its connection pools and the fan-out threads """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upstream')
+        self.lock = Lock()
+        self.latency = {}
+
+    def get(self, name, url, **kwargs):
+        """ GETs url, retrying failures, and returns the last response
+
+        Raises the Timeout or ConnectionError of the last attempt when every attempt failed to connect.
+        """
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self.timeout, **kwargs)
+            except (Timeout, ConnectionError) as e:
+                self._record(name, time.perf_counter() - start, failed=True)
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"{name} request failed: {e} | Retry {attempt + 1} of {self.retries}")
+            else:
+                self._record(name, time.perf_counter() - start, failed=response.status_code >= 500)
+                if response.status_code < 500 or attempt == self.retries:
+                    return response
+                logger.warning(f"{name} returned {response.status_code} | Retry {attempt + 1} of {self.retries}")
+            time.sleep(random.uniform(0, self.backoff_sec * 2 ** attempt))
+
+    def get_all(self, urls, **kwargs):
+        """ GETs every {name: url} concurrently and returns {name: response or the exception raised} """
+        futures = {name: self.executor.submit(self.get, name, url, **kwargs) for name, url in urls.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+        return results
+
+    def _record(self, name, elapsed_sec, failed):
+        """ Records the latency of one attempt """
+        elapsed_ms = elapsed_sec * 1000
+        with self.lock:
+            latency = self.latency.setdefault(name, {'calls': 0, 'failures': 0, 'last_ms': 0.0, 'max_ms': 0.0, 'total_ms': 0.0})
+            latency['calls'] += 1
+            latency['failures'] += failed
+            latency['last_ms'] = round(elapsed_ms, 1)
+            latency['max_ms'] = round(max(latency['max_ms'], elapsed_ms), 1)
+            latency['total_ms'] += elapsed_ms
+
+    def stats(self):
+        """ Returns the call count, failures and last, average and max latency of each upstream """
+        with self.lock:
+            return {name: {'calls': latency['calls'],
+                           'failures': latency['failures'],
+                           'last_ms': latency['last_ms'],
+                           'avg_ms': round(latency['total_ms'] / latency['calls'], 1),
+                           'max_ms': latency['max_ms']}
+                    for name, latency in self.latency.items()}
@@ -1,16 +1,25 @@
 import connexion
 from connexion import NoContent
+from flask import Response
 import json
-import requests
+from requests.exceptions import ConnectionError, Timeout
 import datetime
+import math
 import yaml
 import logging
 import logging.config
+from buckets import Series
 from apscheduler.schedulers.background import BackgroundScheduler
 import os.path
 from collections import Counter
 from connexion.middleware import MiddlewarePosition
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from rollup import DEFAULT_LAST_UPDATED, Rollup, capacity_for
 from starlette.middleware.cors import CORSMiddleware
+from upstream import Upstream
+from threading import Thread
+import time
 import os
 
 # Environment-specific configuration files
@@ -38,80 +47,233 @@ logger.info("Log Conf File: %s" % log_conf_file)
 
 # Event file location from configuration
 EVENT_FILE = app_config["datastore"]["filename"]
+SNAPSHOT_FILE = app_config["datastore"]["snapshot"]
+SERIES_FILE = app_config["datastore"]["series"]
+
+upstream = Upstream(app_config["eventstore"]["timeout"],
+                    retries=app_config["eventstore"]["retries"],
+                    backoff_sec=app_config["eventstore"]["backoff_sec"])
+
+# Running statistics, restored from the last snapshot. Without one they are rebuilt
+# from the first window, which covers every event Storage has.
+rollup = Rollup.load(SNAPSHOT_FILE, capacity_for(app_config["rollup"]["error_bound"]))
+logger.info(f"Tracking up to {rollup.capacity} meters, statistics last updated {rollup.last_updated}")
+
+# Per-minute and per-hour buckets behind /stats/series
+series = Series.load(SERIES_FILE, app_config["series"]["minute_slots"], app_config["series"]["hour_slots"])
+
+def to_epoch(timestamp):
+    """ Converts a %Y-%m-%dT%H:%M:%SZ timestamp to seconds since the epoch """
+    return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+
+def to_timestamp(epoch):
+    """ Converts seconds since the epoch to a %Y-%m-%dT%H:%M:%SZ timestamp """
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def write_stats():
+    """ Writes the statistics to data.json for anything reading them off disk """
+    with open(EVENT_FILE + ".tmp", 'wb') as file:
+        file.write(stats_body)
+    os.replace(EVENT_FILE + ".tmp", EVENT_FILE)
+
+def publish_stats():
+    """ Serializes the current statistics and swaps them in for get_stats
+
+    The body is replaced, never modified, so a request always serves one complete
+    version of the statistics without taking a lock.
+    """
+    global stats_body
+    stats_body = json.dumps(rollup.stats(), indent=2).encode('utf-8')
+
+def persist_stats():
+    """ Snapshots the rollup, the series and data.json if snapshot_sec has passed since the last time
+
+    Returns True when a snapshot was written.
+    """
+    global last_persist
+    if time.time() - last_persist < app_config["datastore"]["snapshot_sec"]:
+        return False
+    rollup.save(SNAPSHOT_FILE)
+    series.save(SERIES_FILE)
+    write_stats()
+    last_persist = time.time()
+    return True
+
+# Serialized statistics served by get_stats, updated in memory and persisted every snapshot_sec
+stats_body = b""
+last_persist = 0.0
+publish_stats()
 
 # Ensure data.json exists
 if not os.path.isfile(EVENT_FILE):
     logger.info(f"{EVENT_FILE} not found. Creating a new one...")
-    with open(EVENT_FILE, 'w') as f:
-        json.dump({'total_status_events': 0, 'total_payment_events': 0, 'most_frequent_meter': None,
-                   'highest_payment': 0, 'last_updated': '2024-01-01T23:59:59Z'}, f)
+    write_stats()
 
 # Function to periodically update stats
 def populate_stats():
     logger.info("Periodic processing started...")
 
-    # Read current stats
-    if os.path.isfile(EVENT_FILE):
-        with open(EVENT_FILE, 'r') as f3:
-            stats = json.load(f3)
-    else:
-        stats = {
-            'total_status_events': 0,
-            'total_payment_events': 0,
-            'most_frequent_meter': None,
-            'highest_payment': 0,
-            'last_updated': '2024-01-01T23:59:59Z'
-        }
-
     # Get timestamps
-    received_timestamp = stats["last_updated"]
-    current_timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+    received_timestamp = rollup.last_updated
+    current_timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
     headers = {'accept': 'application/json'}
     parameters = {
         'start_timestamp': received_timestamp,
-        'end_timestamp': current_timestamp
+        'end_timestamp': current_timestamp,
+        # Every meter of the window, the rollup's error bound only holds if none are left out
+        'all_meters': 'true'
     }
 
-    # Fetch parking status events
-    URL_PARKING = app_config["eventstore"]["parking"]
-    response_parking = requests.get(URL_PARKING, headers=headers, params=parameters)
+    # Fetch the window aggregate, Storage does the counting so only the summary comes over the wire
+    URL_AGGREGATE = app_config["eventstore"]["aggregate"]
+    try:
+        response = upstream.get("aggregate", URL_AGGREGATE, headers=headers, params=parameters)
+    except (Timeout, ConnectionError) as e:
+        logger.error(f"Failed to fetch event aggregate: {e}")
+        return
 
-    if response_parking.status_code != 200:
-        logger.error(f"Failed to fetch parking status events: {response_parking.status_code}")
-    else:
-        parking_data = response_parking.json()
-        num_parking_events = len(parking_data)
-        logger.info(f"Fetched {num_parking_events} parking status events.")
+    if response.status_code != 200:
+        logger.error(f"Failed to fetch event aggregate: {response.status_code}")
+        return
 
-        stats['total_status_events'] += num_parking_events
-        if parking_data:
-            meters = [entry['meter_id'] for entry in parking_data]
-            stats['most_frequent_meter'] = Counter(meters).most_common(1)[0][0]
+    aggregate = response.json()
+    logger.info(f"Fetched aggregate of {aggregate['num_parking_events']} parking status "
+                f"and {aggregate['num_payment_events']} payment events.")
 
-    # Fetch payment events
-    URL_PAYMENT = app_config["eventstore"]["payment"]
-    response_payment = requests.get(URL_PAYMENT, headers=headers, params=parameters)
+    rollup.add_window(aggregate['num_parking_events'],
+                      [(meter['meter_id'], meter['num_events']) for meter in aggregate['top_meters']],
+                      aggregate['num_payment_events'],
+                      aggregate['sum_amount'],
+                      aggregate['max_amount'])
+    rollup.last_updated = current_timestamp
+    # The first window holds every event Storage had before Processing started, so it would
+    # show up as one huge bucket. The series starts from the first regular window instead
+    if received_timestamp != DEFAULT_LAST_UPDATED:
+        series.add(to_epoch(current_timestamp), aggregate['num_parking_events'], aggregate['num_occupied_events'],
+                   aggregate['num_payment_events'], aggregate['sum_amount'], aggregate['max_amount'])
 
-    if response_payment.status_code != 200:
-        logger.error(f"Failed to fetch payment events: {response_payment.status_code}")
-    else:
-        payment_data = response_payment.json()
-        num_payment_events = len(payment_data)
-        logger.info(f"Fetched {num_payment_events} payment events.")
+    # Serve the updated stats straight away, they reach disk with the next snapshot
+    publish_stats()
+    persist_stats()
+
+    logger.debug(rollup.stats())
+    logger.info(f"Periodic processing complete in {upstream.stats()['aggregate']['last_ms']} ms...")
+
+# Kafka tailing mode
+def decode_event(msg):
+    """ Decodes a Kafka message into (type, payload), or None if it cannot be counted """
+    try:
+        event = json.loads(msg.value.decode('utf-8'))
+        return event["type"], event["payload"]
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Failed to decode message at offset {msg.offset}: {e}")
+        return None
+
+def fold_events(messages):
+    """ Folds a micro-batch of messages into the rollup and advances the stored offsets with it """
+    meters = Counter()
+    num_status_events = num_occupied_events = num_payment_events = 0
+    sum_payment = 0.0
+    highest_payment = None
+
+    for msg in messages:
+        decoded = decode_event(msg)
+        if decoded is None:
+            continue
+        event_type, payload = decoded
+        # Read every field before counting anything, so a malformed event is skipped as a whole
+        try:
+            if event_type == "parking_status":
+                meter_id, occupied = int(payload['meter_id']), not payload['status']
+            elif event_type == "payment":
+                amount = float(payload['amount'])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Skipping malformed {event_type} event at offset {msg.offset}: {e}")
+            continue
+
+        if event_type == "parking_status":
+            num_status_events += 1
+            meters[meter_id] += 1
+            # status is true while the spot is free
+            num_occupied_events += occupied
+        elif event_type == "payment":
+            num_payment_events += 1
+            sum_payment += amount
+            highest_payment = amount if highest_payment is None else max(highest_payment, amount)
+
+    rollup.add_window(num_status_events, meters.items(), num_payment_events, sum_payment, highest_payment)
+    for msg in messages:
+        rollup.offsets[msg.partition_id] = msg.offset
+    rollup.last_updated = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    series.add(to_epoch(rollup.last_updated), num_status_events, num_occupied_events,
+               num_payment_events, sum_payment, highest_payment)
 
-        stats['total_payment_events'] += num_payment_events
-        if payment_data:
-            highest_payment = max(entry['amount'] for entry in payment_data)
-            stats['highest_payment'] = max(stats['highest_payment'], highest_payment)
+def connect_events():
+    """ Returns the events topic and a consumer positioned after the last folded offsets, retrying until Kafka answers """
+    kafka_config = app_config['events']
+    consumer_config = kafka_config['consumer']
+    retry_sec = 1
 
-    stats['last_updated'] = current_timestamp
+    while True:
+        try:
+            client = KafkaClient(hosts=f"{kafka_config['hostname']}:{kafka_config['port']}")
+            topic = client.topics[str.encode(kafka_config['topic'])]
+            # Positions come from the snapshot, never from the group. Without any, replay the topic for
+            # fresh statistics, or start at the end of it for statistics built by polling Storage
+            consumer = topic.get_simple_consumer(consumer_group=str.encode(consumer_config['group']),
+                                                 auto_commit_enable=False,
+                                                 auto_offset_reset=OffsetType.EARLIEST if rollup.last_updated == DEFAULT_LAST_UPDATED else OffsetType.LATEST,
+                                                 reset_offset_on_start=True,
+                                                 consumer_timeout_ms=consumer_config['flush_ms'])
+            if rollup.offsets:
+                # The rollup holds the last folded offset, which is what reset_offsets expects
+                consumer.reset_offsets([(topic.partitions[partition_id], offset)
+                                        for partition_id, offset in rollup.offsets.items()
+                                        if partition_id in topic.partitions])
+            return topic, consumer
+        except Exception as e:
+            logger.error(f"Failed to connect to Kafka: {e} | Retrying in {retry_sec} seconds...")
+            time.sleep(retry_sec)
+            retry_sec = min(retry_sec * 2, 30)
 
-    # Write updated stats
-    with open(EVENT_FILE, 'w') as file:
-        json.dump(stats, file, indent=2)
+def tail_events():
+    """ Consumes the events topic in Processing's own group, updating the stats as events arrive
 
-    logger.debug(stats)
-    logger.info("Periodic processing complete...")
+    The offsets are saved in the same snapshot as the statistics, so after a restart
+    consumption resumes exactly where the restored statistics left off. Malformed events
+    are logged and skipped. A Kafka error drops the consumer and reconnects from the
+    offsets folded so far, so the tail never stops for good while the service is up.
+    """
+    kafka_config = app_config['events']
+    consumer_config = kafka_config['consumer']
+
+    while True:
+        topic, consumer = connect_events()
+        logger.info(f"Tailing {kafka_config['topic']} from offsets {rollup.offsets or consumer.held_offsets}")
+        try:
+            while True:
+                messages = []
+                deadline = time.time() + consumer_config['flush_ms'] / 1000
+                while len(messages) < consumer_config['batch_size'] and time.time() < deadline:
+                    msg = consumer.consume(block=True)
+                    if msg is None:
+                        break
+                    messages.append(msg)
+
+                if messages:
+                    fold_events(messages)
+                    publish_stats()
+
+                if persist_stats():
+                    # Only for lag monitoring, the snapshot offsets are the ones used on restart
+                    consumer.commit_offsets()
+        except Exception as e:
+            logger.exception(f"Tailing {kafka_config['topic']} failed, reconnecting: {e}")
+            try:
+                consumer.stop()
+            except Exception:
+                pass
+            time.sleep(1)
 
 # Scheduler initialization
 def init_scheduler():
@@ -121,21 +283,43 @@ def init_scheduler():
 
 # Endpoint to get stats
 def get_stats():
-    logger.info("===> Request for stats started...")
-    if os.path.isfile(EVENT_FILE):
-        with open(EVENT_FILE, 'r') as f4:
-            statsread = json.load(f4)
-    else:
-        logger.error(f"Stats file {EVENT_FILE} cannot be found")
-        return {"message": "Statistics do not exist"}, 404
+    """ Serves the in-memory statistics, already serialized, without touching disk """
+    logger.debug("===> Request for stats")
+    return Response(stats_body, mimetype='application/json')
+
+# Endpoint to get stats over time
+def get_series(from_, to=None, step=60):
+    """ Gets the event counts, occupancy and payments in step second points from the time buckets """
+    now = time.time()
+    try:
+        start = to_epoch(from_)
+        end = min(to_epoch(to), now) if to else now
+    except ValueError:
+        return {"message": "from and to must be timestamps like 2024-08-29T09:12:00Z"}, 400
+    if step % 60:
+        return {"message": "step must be a multiple of 60 seconds"}, 400
 
-    logger.debug(statsread)
-    logger.info("===> Request for stats complete...")
-    return statsread, 200
+    try:
+        resolution, points = series.query(start, end, step, now, app_config['series']['max_points'])
+    except ValueError as e:
+        return {"message": str(e)}, 400
+    return {
+        "step": step,
+        "resolution": resolution,
+        "points": [{
+            "timestamp": to_timestamp(point_start),
+            "num_status_events": num_status,
+            "num_payment_events": num_payment,
+            "occupancy_ratio": num_occupied / num_status if num_status else None,
+            "highest_payment": None if math.isnan(highest_payment) else highest_payment,
+            "sum_payment": sum_payment
+        } for point_start, num_status, num_occupied, num_payment, sum_payment, highest_payment in points]
+    }, 200
 
 # App with CORS middleware
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", base_path="/processing", strict_validation=True, validate_responses=True)
+# pythonic_params maps the from query parameter, a Python keyword, to from_
+app.add_api("openapi.yml", base_path="/processing", strict_validation=True, validate_responses=True, pythonic_params=True)
 
 # Disable CORS in the test environment
 if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
@@ -149,5 +333,8 @@ if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     )
 
 if __name__ == "__main__":
-    init_scheduler()
+    if app_config['source'] == "kafka":
+        Thread(target=tail_events, name='kafka-tail', daemon=True).start()
+    else:
+        init_scheduler()
     app.run(port=8100, host="0.0.0.0")
@@ -0,0 +1,181 @@
+import math
+import os
+import struct
+from array import array
+from threading import Lock
+
+# magic, version, number of resolutions
+HEADER = struct.Struct(">4sHI")
+# bucket width in seconds, number of slots
+RESOLUTION = struct.Struct(">II")
+MAGIC = b"SERS"
+VERSION = 1
+
+
+def nanmax(a, b):
+    """ Returns the larger of a and b, where nan marks a bucket without payments """
+    return b if math.isnan(a) or b > a else a
+
+
+class Ring:
+    """ Fixed-width buckets of one resolution, held in parallel arrays used as a ring buffer
+
+    Bucket n lives in slot n % slots, so writing a new bucket over a slot drops the one
+    that was there slots buckets ago and retention never needs a separate sweep.
+    """
+
+    def __init__(self, step_sec, slots):
+        """ Initializes slots empty buckets of step_sec seconds each """
+        self.step_sec = step_sec
+        self.slots = slots
+        # Bucket number held by each slot, -1 while the slot has never been written
+        self.bucket = array('q', [-1]) * slots
+        self.num_status = array('q', [0]) * slots
+        self.num_occupied = array('q', [0]) * slots
+        self.num_payment = array('q', [0]) * slots
+        self.sum_payment = array('d', [0.0]) * slots
+        self.max_payment = array('d', [math.nan]) * slots
+        # Newest bucket written, the ring retains it and the slots - 1 before it
+        self.newest = -1
+
+    def arrays(self):
+        """ Returns the arrays in snapshot order """
+        return (self.bucket, self.num_status, self.num_occupied, self.num_payment, self.sum_payment, self.max_payment)
+
+    def add(self, epoch, num_status, num_occupied, num_payment, sum_payment, highest_payment):
+        """ Adds counts to the bucket holding epoch, unless it is older than the ring retains """
+        bucket = int(epoch // self.step_sec)
+        slot = bucket % self.slots
+        if self.bucket[slot] > bucket:
+            return
+        if self.bucket[slot] != bucket:
+            self.bucket[slot] = bucket
+            self.newest = max(self.newest, bucket)
+            self.num_status[slot] = self.num_occupied[slot] = self.num_payment[slot] = 0
+            self.sum_payment[slot] = 0.0
+            self.max_payment[slot] = math.nan
+        self.num_status[slot] += num_status
+        self.num_occupied[slot] += num_occupied
+        self.num_payment[slot] += num_payment
+        if num_payment:
+            self.sum_payment[slot] += sum_payment
+            self.max_payment[slot] = nanmax(self.max_payment[slot], highest_payment)
+
+    def oldest(self, epoch):
+        """ Returns the start of the oldest bucket still retained when epoch is the newest """
+        return (int(epoch // self.step_sec) - self.slots + 1) * self.step_sec
+
+    def merge(self, first, last):
+        """ Returns the counts of buckets first to last, inclusive, merged into one point
+
+        The range is clamped to the buckets the ring can still hold, so a point costs at
+        most slots iterations however wide it is.
+        """
+        num_status = num_occupied = num_payment = 0
+        sum_payment = 0.0
+        highest_payment = math.nan
+        for bucket in range(max(first, self.newest - self.slots + 1), min(last, self.newest) + 1):
+            slot = bucket % self.slots
+            if self.bucket[slot] != bucket:
+                continue
+            num_status += self.num_status[slot]
+            num_occupied += self.num_occupied[slot]
+            num_payment += self.num_payment[slot]
+            sum_payment += self.sum_payment[slot]
+            highest_payment = nanmax(highest_payment, self.max_payment[slot])
+        return num_status, num_occupied, num_payment, sum_payment, highest_payment
+
+
+class Series:
+    """ Per-minute and per-hour event counts, occupancy and payments for trend queries
+
+    Every window is added to both rings, so hours are downsampled from the same events
+    as minutes and outlive them. A query reads the finest ring that still covers its
+    start and merges its buckets into points of the requested step, so it costs
+    O(buckets) however many events they summarise.
+    """
+
+    def __init__(self, minute_slots, hour_slots):
+        """ Initializes empty rings retaining minute_slots minutes and hour_slots hours """
+        self.rings = [Ring(60, minute_slots), Ring(3600, hour_slots)]
+        self.lock = Lock()
+
+    def add(self, epoch, num_status, num_occupied, num_payment, sum_payment, highest_payment):
+        """ Adds a window of events to the buckets holding epoch """
+        with self.lock:
+            for ring in self.rings:
+                ring.add(epoch, num_status, num_occupied, num_payment, sum_payment, highest_payment)
+
+    def ring_for(self, start, step, now):
+        """ Returns the finest ring whose buckets divide step, preferring one that still retains start """
+        rings = [ring for ring in self.rings if step % ring.step_sec == 0]
+        for ring in rings:
+            if ring.oldest(now) <= start:
+                return ring
+        return rings[-1]
+
+    def query(self, start, end, step, now, max_points):
+        """ Returns (bucket width, points) covering [start, end) in step second points
+
+        step must be a multiple of 60. start is clamped to the oldest retained bucket and
+        both ends are aligned down to step, so points always cover whole buckets. Raises
+        ValueError if that would take more than max_points points.
+        """
+        with self.lock:
+            ring = self.ring_for(start, step, now)
+            start = max(start, ring.oldest(now))
+            start -= start % step
+            if (end - start) / step > max_points:
+                raise ValueError(f"The series would have more than {max_points} points, use a larger step or a shorter range")
+            points = []
+            for point_start in range(int(start), int(end), step):
+                first = point_start // ring.step_sec
+                points.append((point_start, *ring.merge(first, first + step // ring.step_sec - 1)))
+            return ring.step_sec, points
+
+    def to_bytes(self):
+        """ Packs the rings into the binary snapshot format, arrays in machine byte order """
+        with self.lock:
+            parts = [HEADER.pack(MAGIC, VERSION, len(self.rings))]
+            for ring in self.rings:
+                parts.append(RESOLUTION.pack(ring.step_sec, ring.slots))
+                parts.extend(values.tobytes() for values in ring.arrays())
+            return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data, minute_slots, hour_slots):
+        """ Unpacks a binary snapshot, starting a ring empty if its retention has been reconfigured """
+        magic, version, num_rings = HEADER.unpack_from(data)
+        if magic != MAGIC or version > VERSION:
+            raise ValueError(f"Not a series snapshot of version {VERSION} or earlier")
+
+        series = cls(minute_slots, hour_slots)
+        configured = {ring.step_sec: ring for ring in series.rings}
+        offset = HEADER.size
+        for _ in range(num_rings):
+            step_sec, slots = RESOLUTION.unpack_from(data, offset)
+            offset += RESOLUTION.size
+            ring = configured.get(step_sec)
+            for values in (ring.arrays() if ring is not None and ring.slots == slots else Ring(step_sec, slots).arrays()):
+                size = slots * values.itemsize
+                values[:] = array(values.typecode, data[offset:offset + size])
+                offset += size
+        for ring in series.rings:
+            ring.newest = max(ring.bucket)
+        return series
+
+    def save(self, path):
+        """ Writes the snapshot to a temporary file and renames it over path, so a crash never leaves half a snapshot """
+        with open(path + ".tmp", 'wb') as f:
+            f.write(self.to_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, minute_slots, hour_slots):
+        """ Reads the snapshot at path, or returns empty rings if there is none """
+        if not os.path.isfile(path):
+            return cls(minute_slots, hour_slots)
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read(), minute_slots, hour_slots)
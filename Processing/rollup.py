@@ -0,0 +1,170 @@
+import heapq
+import math
+import os
+import struct
+
+# magic, version, capacity, status events, payment events, payment sum, payment max, meters, last_updated
+HEADER = struct.Struct(">4sHIQQddI20s")
+# meter_id, count, overestimate
+METER = struct.Struct(">qQQ")
+# number of partitions, then partition id and last consumed offset for each (version 2 onwards)
+OFFSET_COUNT = struct.Struct(">I")
+OFFSET = struct.Struct(">Iq")
+MAGIC = b"RLUP"
+VERSION = 2
+DEFAULT_LAST_UPDATED = "2024-01-01T23:59:59Z"
+
+
+def capacity_for(error_bound):
+    """ Returns the number of meters to track so no count is overestimated by more than error_bound of all events """
+    return math.ceil(1 / error_bound)
+
+
+class Rollup:
+    """ All-time parking and payment statistics kept in a fixed amount of memory
+
+    Meter activity is tracked with weighted Space-Saving over at most capacity meters.
+    While there are no more meters than that every count is exact. Past it, a new meter
+    takes over the slot of the least active one and inherits its count as an
+    overestimate, so any count is at most total_status_events / capacity too high and
+    every meter with more than that share of the events is guaranteed to be tracked.
+    This holds as long as every meter's events are added, not only the busiest ones.
+
+    The least active meter is found with a min-heap of (count, meter_id). Entries are
+    pushed whenever a count changes and stale ones are skipped when popped, so an
+    update costs O(log capacity) amortized, and the heap is rebuilt from the counts
+    once it holds twice as many entries as there are meters.
+    """
+
+    def __init__(self, capacity):
+        """ Initializes empty statistics tracking up to capacity meters """
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total_status_events = 0
+        self.total_payment_events = 0
+        self.sum_payment = 0.0
+        self.highest_payment = None
+        self.last_updated = DEFAULT_LAST_UPDATED
+        # Last consumed offset per partition of the events topic when tailing Kafka
+        self.offsets = {}
+
+    def add_meters(self, meter_counts):
+        """ Adds the number of new parking status events per meter, O(log capacity) amortized per meter """
+        for meter_id, num_events in meter_counts:
+            if meter_id in self.counts:
+                self.counts[meter_id] += num_events
+            elif len(self.counts) < self.capacity:
+                self.counts[meter_id] = num_events
+                self.errors[meter_id] = 0
+            else:
+                evicted = self.pop_least_active()
+                floor = self.counts.pop(evicted)
+                del self.errors[evicted]
+                self.counts[meter_id] = floor + num_events
+                self.errors[meter_id] = floor
+            self.push(meter_id)
+
+    def push(self, meter_id):
+        """ Records the current count of meter_id in the heap, rebuilding it once stale entries pile up """
+        if len(self.heap) >= 2 * max(len(self.counts), 1):
+            self.rebuild_heap()
+        else:
+            heapq.heappush(self.heap, (self.counts[meter_id], meter_id))
+
+    def rebuild_heap(self):
+        """ Replaces the heap with one entry per tracked meter """
+        self.heap = [(count, meter_id) for meter_id, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def pop_least_active(self):
+        """ Returns the tracked meter with the lowest count, dropping stale heap entries on the way """
+        while True:
+            count, meter_id = heapq.heappop(self.heap)
+            # Every meter has an entry with its current count, so the first one that matches is the minimum
+            if self.counts.get(meter_id) == count:
+                return meter_id
+
+    def add_window(self, num_status_events, top_meters, num_payment_events, sum_payment, highest_payment):
+        """ Folds the aggregate of one window into the running statistics """
+        self.total_status_events += num_status_events
+        self.add_meters(top_meters)
+        self.total_payment_events += num_payment_events
+        if num_payment_events:
+            self.sum_payment += sum_payment
+            if self.highest_payment is None or highest_payment > self.highest_payment:
+                self.highest_payment = highest_payment
+
+    def most_frequent_meter(self):
+        """ Returns (meter_id, count, overestimate) of the most active meter, or None before any event """
+        if not self.counts:
+            return None
+        meter_id = max(self.counts, key=self.counts.get)
+        return meter_id, self.counts[meter_id], self.errors[meter_id]
+
+    def stats(self):
+        """ Returns the statistics in the shape served by /parking/stats """
+        top = self.most_frequent_meter()
+        return {
+            'total_status_events': self.total_status_events,
+            'total_payment_events': self.total_payment_events,
+            'most_frequent_meter': top[0] if top else None,
+            'most_frequent_meter_events': top[1] if top else 0,
+            'highest_payment': self.highest_payment or 0,
+            'average_payment': self.sum_payment / self.total_payment_events if self.total_payment_events else 0,
+            'last_updated': self.last_updated
+        }
+
+    def to_bytes(self):
+        """ Packs the statistics into the binary snapshot format """
+        parts = [HEADER.pack(MAGIC, VERSION, self.capacity, self.total_status_events, self.total_payment_events,
+                             self.sum_payment, math.nan if self.highest_payment is None else self.highest_payment,
+                             len(self.counts), self.last_updated.encode('ascii'))]
+        parts.extend(METER.pack(meter_id, count, self.errors[meter_id]) for meter_id, count in self.counts.items())
+        parts.append(OFFSET_COUNT.pack(len(self.offsets)))
+        parts.extend(OFFSET.pack(partition_id, offset) for partition_id, offset in self.offsets.items())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data, capacity):
+        """ Unpacks a binary snapshot, keeping the most active meters if capacity has shrunk """
+        magic, version, _, num_status, num_payment, sum_payment, highest, num_meters, last_updated = HEADER.unpack_from(data)
+        if magic != MAGIC or version > VERSION:
+            raise ValueError(f"Not a rollup snapshot of version {VERSION} or earlier")
+
+        rollup = cls(capacity)
+        rollup.total_status_events = num_status
+        rollup.total_payment_events = num_payment
+        rollup.sum_payment = sum_payment
+        rollup.highest_payment = None if math.isnan(highest) else highest
+        rollup.last_updated = last_updated.rstrip(b"\0").decode('ascii')
+        end = HEADER.size + num_meters * METER.size
+        meters = sorted(METER.iter_unpack(data[HEADER.size:end]), key=lambda meter: meter[1], reverse=True)
+        for meter_id, count, error in meters[:capacity]:
+            rollup.counts[meter_id] = count
+            rollup.errors[meter_id] = error
+        rollup.rebuild_heap()
+
+        # Version 1 snapshots were only written when polling Storage and carry no offsets
+        if version >= 2:
+            num_offsets, = OFFSET_COUNT.unpack_from(data, end)
+            start = end + OFFSET_COUNT.size
+            rollup.offsets = dict(OFFSET.iter_unpack(data[start:start + num_offsets * OFFSET.size]))
+        return rollup
+
+    def save(self, path):
+        """ Writes the snapshot to a temporary file and renames it over path, so a crash never leaves half a snapshot """
+        with open(path + ".tmp", 'wb') as f:
+            f.write(self.to_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, capacity):
+        """ Reads the snapshot at path, or returns empty statistics if there is none """
+        if not os.path.isfile(path):
+            return cls(capacity)
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read(), capacity)
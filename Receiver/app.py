@@ -8,6 +8,14 @@ import logging
 import logging.config
 import uuid
 from pykafka import KafkaClient
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import AbstractRequestBodyValidator, VALIDATOR_MAP
+from flask import request
+from jsonschema import Draft4Validator, FormatChecker
+from publisher import create_publisher, new_metrics
+from spool import Spool, SpoolFull
+from threading import Thread
+import atexit
 import time
 import os
 
@@ -32,57 +40,204 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-# connecting kafka
-max_retries = 5
-retry_count = 0
+spool = Spool(app_config['spool']['directory'],
+              segment_bytes=app_config['spool']['segment_bytes'],
+              max_bytes=app_config['spool']['max_bytes'],
+              fsync=app_config['spool']['fsync'])
+atexit.register(spool.close)
+RETRY_AFTER = {"Retry-After": str(app_config['spool']['retry_after_sec'])}
+
+topic = None
+publisher = None
+
+def connect_kafka():
+    """ Connects to Kafka in the background, events are spooled until the broker is reachable """
+    global topic, publisher
+    retry_sec = 1
+
+    while publisher is None:
+        try:
+            client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
+            topic = client.topics[str.encode(app_config['events']['topic'])]
+            publisher = create_publisher(topic, app_config['events']['producer'], on_failure=spool.append)
+            atexit.register(publisher.stop)
+            logger.info(f"Succesfully connected to Kafka ({app_config['events']['producer']['mode']} producer)")
+        except Exception as e:
+            logger.error(f"Failed to connect to Kafka: {e} | Retrying in {retry_sec} seconds...")
+            time.sleep(retry_sec)
+            retry_sec = min(retry_sec * 2, app_config['spool']['max_retry_sec'])
+
+def drain_spool():
+    """ Replays spooled events into the events topic in the order they were accepted """
+    producer = None
+
+    while True:
+        records = spool.read(app_config['spool']['drain_batch']) if topic is not None else []
+        if not records:
+            time.sleep(1)
+            continue
+
+        sent = None
+        count = 0
+        try:
+            if producer is None:
+                producer = topic.get_sync_producer()
+            for record, cursor in records:
+                producer.produce(record)
+                sent = cursor
+                count += 1
+        except Exception as e:
+            logger.error(f"Failed to replay spooled events: {e} | Retrying in 5 seconds...")
+            time.sleep(5)
+
+        if sent is not None:
+            spool.commit(sent, count)
+            logger.info(f"Replayed {count} spooled events, {spool.size()} bytes still spooled")
+
+def publish(data):
+    """ Sends an encoded event to Kafka, or to the spool while the broker is down, slow or backlogged
+
+    Once anything is spooled, new events are spooled behind it so the drainer keeps them in order.
+    """
+    if publisher is None or spool.size() > 0:
+        spool.append(data)
+        return
 
-while retry_count < max_retries:
     try:
-        client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-        topic = client.topics[str.encode(app_config['events']['topic'])]
-        producer = topic.get_sync_producer()
-        logger.info(f"Succesfully connected to Kafka")
-        break
+        publisher.publish(data)
     except Exception as e:
-        logger.error(f"Failed to connect to Kafka: {e} | Retrying in 5 seconds...")
-        time.sleep(5)
-        retry_count += 1
+        logger.warning(f"Spooling event, producer did not take it: {e}")
+        spool.append(data)
 
-def log_data(event, event_type):
-    header = {"Content-Type": "application/json"}
-    
+Thread(target=connect_kafka, name='kafka-connect', daemon=True).start()
+Thread(target=drain_spool, name='spool-drainer', daemon=True).start()
+
+# Per-event validators for the batch endpoint, built from the same schemas connexion uses
+with open("openapi.yml", 'r') as f3:
+    api_spec = yaml.safe_load(f3.read())
+
+EVENT_VALIDATORS = {
+    "parking_status": Draft4Validator(api_spec['components']['schemas']['ParkingStatusEvent'], format_checker=FormatChecker()),
+    "payment": Draft4Validator(api_spec['components']['schemas']['PaymentEvent'], format_checker=FormatChecker())
+}
+
+def build_message(event, event_type):
+    """ Assigns a trace id to the event and wraps it in the Kafka message envelope """
     trace_id = str(uuid.uuid4())
     event["trace_id"] = trace_id
 
-    logger.info(f'Received event {event_type} request with a trace id of {trace_id}')
-    
     msg = {
         "type": event_type,
         "datetime": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
         "payload": event
     }
-    msg_str = json.dumps(msg)
-    producer.produce(msg_str.encode('utf-8'))
-    
+    return trace_id, json.dumps(msg)
+
+def log_data(event, event_type):
+    trace_id, msg_str = build_message(event, event_type)
+
+    logger.info(f'Received event {event_type} request with a trace id of {trace_id}')
+
+    try:
+        publish(msg_str.encode('utf-8'))
+    except SpoolFull:
+        logger.warning(f'Rejected event {event_type} (Id: {trace_id}) with status 503, spool is full')
+        return msg_str, 503, RETRY_AFTER
+
     logger.info(f'Returned event {event_type} response (Id: {trace_id}) with status 201')
 
-    return msg_str, 201
+    return msg_str, 201, {}
 
 def parking_status(body):
     res = log_data(body, "parking_status")
-    return NoContent, res[1]
+    return NoContent, res[1], res[2]
 
 def payment(body):
     res = log_data(body, "payment")
-    return NoContent, res[1]
+    return NoContent, res[1], res[2]
+
+class NDJSONRequestBodyValidator(AbstractRequestBodyValidator):
+    """ Leaves NDJSON bodies unread so the batch handler can stream and validate them line by line """
+
+    async def wrap_receive(self, receive, *, scope):
+        return receive
+
+def read_ndjson(stream):
+    """ Yields one decoded event per line of an NDJSON request body """
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON: {e}")
+
+def batch():
+    """ Receives a JSON array or NDJSON stream of mixed parking_status and payment events """
+    if request.mimetype == "application/x-ndjson":
+        items = read_ndjson(request.stream)
+    else:
+        items = request.get_json()
+
+    max_events = app_config['batch']['max_events']
+    results = []
+    num_accepted = 0
+
+    for index, item in enumerate(items):
+        if index >= max_events:
+            # One entry covers every event past the limit, the rest of an NDJSON body is never read
+            results.append({"index": index, "status": 413,
+                            "message": f"Batch is limited to {max_events} events, this and later events were not received"})
+            break
+        if isinstance(item, ValueError):
+            results.append({"index": index, "status": 400, "message": str(item)})
+            continue
+
+        event_type = item.get("type") if isinstance(item, dict) else None
+        if event_type not in EVENT_VALIDATORS:
+            results.append({"index": index, "status": 400, "message": f"Unknown event type {event_type}"})
+            continue
+        error = next(EVENT_VALIDATORS[event_type].iter_errors(item.get("payload")), None)
+        if error is not None:
+            results.append({"index": index, "status": 400, "message": error.message})
+            continue
+
+        trace_id, msg_str = build_message(item["payload"], event_type)
+        try:
+            publish(msg_str.encode('utf-8'))
+        except SpoolFull:
+            results.append({"index": index, "status": 503, "trace_id": trace_id, "message": "Spool is full"})
+            continue
+        results.append({"index": index, "status": 201, "trace_id": trace_id})
+        num_accepted += 1
+
+    logger.info(f'Batch request accepted {num_accepted} of {len(results)} events')
+
+    if num_accepted == len(results):
+        return results, 201
+    if any(result["status"] == 503 for result in results):
+        return results, 207, RETRY_AFTER
+    return results, 207
 
 def get_check():
     logger.info("Health check endpoint hit.")
     return NoContent, 200
 
+def get_metrics():
+    """ Gets the Kafka producer delivery and spool metrics """
+    if publisher is None:
+        stats = new_metrics(app_config['events']['producer']['mode'])
+    else:
+        stats = publisher.stats()
+    stats.update(spool.stats())
+    stats['connected'] = publisher is not None
+    return stats, 200
+
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", base_path="/receiver", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yml", base_path="/receiver", strict_validation=True, validate_responses=True,
+            validator_map={"body": MediaTypeDict({**VALIDATOR_MAP["body"], "application/x-ndjson": NDJSONRequestBodyValidator})})
 
 if __name__ == "__main__":
     app.run(port=8080, host="0.0.0.0")
@@ -0,0 +1,207 @@
+import json
+import logging
+import queue
+import time
+from threading import Lock, Thread
+
+logger = logging.getLogger('basicLogger')
+
+_STOP = object()
+
+
+class PublisherFull(Exception):
+    """ Raised when the in-flight queue cannot accept another event """
+
+
+class PublisherStopped(Exception):
+    """ Raised when an event arrives after the publisher started flushing for shutdown """
+
+
+def new_metrics(mode):
+    """ Returns zeroed delivery metrics for a publisher """
+    return {
+        'mode': mode,
+        'accepted': 0,
+        'delivered': 0,
+        'failed': 0,
+        'rejected': 0,
+        'queue_depth': 0,
+        'last_error': None
+    }
+
+
+class SyncPublisher:
+    """ Produces each event with a blocking round trip to the broker """
+
+    def __init__(self, topic):
+        """ Initializes a synchronous publisher for the given topic """
+        self.producer = topic.get_sync_producer()
+        self.lock = Lock()
+        self.metrics = new_metrics('sync')
+
+    def publish(self, data):
+        """ Sends one encoded event and waits for the broker acknowledgement """
+        with self.lock:
+            self.metrics['accepted'] += 1
+        try:
+            self.producer.produce(data)
+        except Exception as e:
+            with self.lock:
+                self.metrics['failed'] += 1
+                self.metrics['last_error'] = str(e)
+            raise
+        with self.lock:
+            self.metrics['delivered'] += 1
+
+    def stats(self):
+        """ Returns a copy of the delivery metrics """
+        with self.lock:
+            return dict(self.metrics)
+
+    def stop(self):
+        """ Stops the underlying producer """
+        self.producer.stop()
+
+
+class AsyncPublisher:
+    """ Hands events to a background thread that owns an async pykafka producer
+
+    pykafka delivers reports on a queue local to the producing thread, so every
+    produce call and every delivery report read happens on the worker thread.
+    Request threads only pay for an append to the bounded in-flight queue.
+    """
+
+    def __init__(self, topic, linger_ms, max_batch_size, max_queued_messages, on_failure=None):
+        """ Initializes the in-flight queue and starts the producer thread
+
+        on_failure is called with the encoded event when the broker does not acknowledge it.
+        """
+        self.on_failure = on_failure
+        self.queue = queue.Queue(maxsize=max_queued_messages)
+        self.producer = topic.get_producer(sync=False,
+                                           delivery_reports=True,
+                                           linger_ms=linger_ms,
+                                           min_queued_messages=max_batch_size,
+                                           max_queued_messages=max_queued_messages,
+                                           block_on_queue_full=True)
+        self.lock = Lock()
+        self.metrics = new_metrics('async')
+        self.stopping = False
+        self.thread = Thread(target=self._run, name='kafka-publisher', daemon=True)
+        self.thread.start()
+
+    def publish(self, data):
+        """ Queues one encoded event
+
+        Raises PublisherFull when the queue is at capacity and PublisherStopped once stop() was
+        called, so the caller can spool the event instead.
+        """
+        if self.stopping:
+            raise PublisherStopped("Publisher is shutting down")
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            with self.lock:
+                self.metrics['rejected'] += 1
+            raise PublisherFull("In-flight queue is full")
+        with self.lock:
+            self.metrics['accepted'] += 1
+
+    def on_delivery(self, msg, exc):
+        """ Records the outcome of a single delivery report """
+        self._record(msg.value, exc)
+
+    def _record(self, data, exc):
+        """ Updates the delivery metrics and logs the trace id of failed events """
+        with self.lock:
+            if exc is None:
+                self.metrics['delivered'] += 1
+                return
+            self.metrics['failed'] += 1
+            self.metrics['last_error'] = str(exc)
+
+        try:
+            trace_id = json.loads(data)['payload']['trace_id']
+        except (ValueError, KeyError, TypeError):
+            trace_id = None
+        logger.error(f'Failed to deliver event with a trace id of {trace_id}: {exc}')
+
+        if self.on_failure is not None:
+            try:
+                self.on_failure(data)
+            except Exception as e:
+                logger.error(f'Lost event with a trace id of {trace_id}: {e}')
+
+    def _drain_reports(self):
+        """ Reads every delivery report currently available without blocking """
+        while True:
+            try:
+                msg, exc = self.producer.get_delivery_report(block=False)
+            except queue.Empty:
+                return
+            self.on_delivery(msg, exc)
+
+    def _produce(self, data):
+        """ Hands one event to the producer, recording it as failed if the producer refuses it """
+        try:
+            self.producer.produce(data)
+        except Exception as e:
+            self._record(data, e)
+
+    def _run(self):
+        """ Moves events from the in-flight queue into the producer """
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                break
+            if item is not None:
+                self._produce(item)
+            self._drain_reports()
+
+        # An event queued by a publish that raced stop() sits behind the sentinel
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                self._produce(item)
+
+        # stop() blocks until every queued message has been sent
+        self.producer.stop()
+        self._drain_reports()
+
+    def stats(self):
+        """ Returns a copy of the delivery metrics """
+        with self.lock:
+            stats = dict(self.metrics)
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
+
+    def stop(self, timeout=30):
+        """ Flushes every accepted event to the broker and stops the producer thread
+
+        Events published from here on raise PublisherStopped rather than queue behind the flush.
+        """
+        if not self.thread.is_alive():
+            return
+        start = time.time()
+        self.stopping = True
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        logger.info(f'Publisher flushed in {time.time() - start:.2f}s with stats {self.stats()}')
+
+
+def create_publisher(topic, producer_config, on_failure=None):
+    """ Builds the publisher selected by the producer mode in app_conf.yml """
+    if producer_config['mode'] == 'async':
+        return AsyncPublisher(topic,
+                              linger_ms=producer_config['linger_ms'],
+                              max_batch_size=producer_config['max_batch_size'],
+                              max_queued_messages=producer_config['max_queued_messages'],
+                              on_failure=on_failure)
+    return SyncPublisher(topic)
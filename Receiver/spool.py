@@ -0,0 +1,178 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from threading import Lock
+
+logger = logging.getLogger('basicLogger')
+
+# Every record is framed as <length><crc32><data> so a torn write can be detected on restart
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_NAME = "segment-%010d.log"
+CURSOR_FILE = "cursor.json"
+
+
+class SpoolFull(Exception):
+    """ Raised when the spool has reached its size limit """
+
+
+class Spool:
+    """ Segmented append-only write-ahead spool for events the broker could not take
+
+    Events are appended to the newest segment until it reaches segment_bytes,
+    then a new segment is started. The drainer reads from the cursor through a
+    memory map of the segment and commits the cursor once the broker has
+    acknowledged the events, which deletes fully drained segments.
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes, fsync=False):
+        """ Opens the spool directory and recovers the cursor and active segment """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.lock = Lock()
+        self.metrics = {'spooled': 0, 'drained': 0, 'spool_rejected': 0}
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[8:18]) for name in os.listdir(directory)
+                               if name.startswith("segment-") and name.endswith(".log"))
+        self.cursor = self._load_cursor()
+        if self.segments:
+            self._recover(self.segments[-1])
+        else:
+            self.segments.append(self.cursor[0])
+
+        active = self.segments[-1]
+        self.active = open(self._path(active), 'ab', buffering=0)
+        self.sizes = {segment: os.path.getsize(self._path(segment)) for segment in self.segments}
+        logger.info(f"Spool opened at {directory} with {self.size()} pending bytes in {len(self.segments)} segments")
+
+    def _path(self, segment):
+        return os.path.join(self.directory, SEGMENT_NAME % segment)
+
+    def _load_cursor(self):
+        """ Reads the (segment, position) of the next undrained record """
+        path = os.path.join(self.directory, CURSOR_FILE)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                cursor = json.load(f)
+            if cursor['segment'] in self.segments:
+                return cursor['segment'], cursor['position']
+        if self.segments:
+            return self.segments[0], 0
+        return 1, 0
+
+    def _recover(self, segment):
+        """ Truncates a record left half-written by a crash at the end of the newest segment """
+        path = self._path(segment)
+        size = os.path.getsize(path)
+        position = self.cursor[1] if self.cursor[0] == segment else 0
+        if size > 0:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for _, position in self._records(data, position, size):
+                    pass
+        if position < size:
+            logger.warning(f"Truncating {size - position} bytes of a torn record from {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(position)
+
+    @staticmethod
+    def _records(data, position, end):
+        """ Yields (record, next_position) for every intact record between position and end """
+        while position + RECORD_HEADER.size <= end:
+            length, crc = RECORD_HEADER.unpack_from(data, position)
+            start = position + RECORD_HEADER.size
+            if start + length > end:
+                return
+            record = data[start:start + length]
+            if zlib.crc32(record) != crc:
+                return
+            position = start + length
+            yield record, position
+
+    def size(self):
+        """ Returns the number of bytes appended but not yet drained """
+        with self.lock:
+            return sum(self.sizes.values()) - self.cursor[1]
+
+    def append(self, data):
+        """ Appends one encoded event, raising SpoolFull once the size limit is reached """
+        record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            if sum(self.sizes.values()) - self.cursor[1] + len(record) > self.max_bytes:
+                self.metrics['spool_rejected'] += 1
+                raise SpoolFull(f"Spool has reached its limit of {self.max_bytes} bytes")
+
+            active = self.segments[-1]
+            self.active.write(record)
+            if self.fsync:
+                os.fsync(self.active.fileno())
+            self.sizes[active] += len(record)
+            self.metrics['spooled'] += 1
+
+            if self.sizes[active] >= self.segment_bytes:
+                os.fsync(self.active.fileno())
+                self.active.close()
+                self.segments.append(active + 1)
+                self.sizes[active + 1] = 0
+                self.active = open(self._path(active + 1), 'ab', buffering=0)
+
+    def read(self, max_records):
+        """ Returns up to max_records (record, cursor) pairs starting at the cursor, in append order
+
+        Each cursor is the position just after its record and can be passed to commit().
+        """
+        while True:
+            with self.lock:
+                segment, position = self.cursor
+                end = self.sizes[segment]
+                last = segment == self.segments[-1]
+            if position < end:
+                break
+            if last:
+                return []
+            # The segment is fully drained, move on to the next one
+            self.commit((segment + 1, 0))
+
+        with open(self._path(segment), 'rb') as f, mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as data:
+            records = []
+            for record, next_position in self._records(data, position, end):
+                records.append((record, (segment, next_position)))
+                if len(records) >= max_records:
+                    break
+        return records
+
+    def commit(self, cursor, count=0):
+        """ Moves the cursor past count acknowledged records and deletes drained segments """
+        segment, position = cursor
+        with self.lock:
+            self.metrics['drained'] += count
+            drained = [s for s in self.segments if s < segment]
+            for s in drained:
+                self.segments.remove(s)
+                del self.sizes[s]
+            self.cursor = (segment, position)
+
+        for s in drained:
+            os.remove(self._path(s))
+
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({'segment': segment, 'position': position}, f)
+        os.replace(path + ".tmp", path)
+
+    def stats(self):
+        """ Returns the spool size and counters """
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['spool_bytes'] = sum(self.sizes.values()) - self.cursor[1]
+            stats['spool_segments'] = len(self.segments)
+        return stats
+
+    def close(self):
+        """ Closes the active segment """
+        with self.lock:
+            self.active.close()
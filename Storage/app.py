@@ -1,10 +1,22 @@
 import connexion
-from connexion import NoContent
-from sqlalchemy import and_, create_engine
+from connexion import NoContent, problem, request
+from connexion.datastructures import MediaTypeDict
+from connexion.jsonifier import JSONEncoder
+from connexion.validators import AbstractResponseBodyValidator, VALIDATOR_MAP
+from contextlib import asynccontextmanager
+from sqlalchemy import create_engine, insert, select, update
+from sqlalchemy.exc import TimeoutError as PoolTimeout
 from sqlalchemy.orm import sessionmaker
 from base import Base
+from event_counter import EventCounter
+from event_trace import EventTrace
 from parking_status import ParkingStatus
 from payment import PaymentEvent
+from read_pool import ReadPool
+from response_cache import ResponseCache
+from starlette.responses import Response, StreamingResponse
+from queries import (count_select, decode_cursor, encode_cursor, insert_ignore, max_sum_select, range_select,
+                     top_meters_select, utc_now)
 import datetime
 import pymysql
 import yaml
@@ -13,7 +25,7 @@ import logging.config
 import json
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from threading import Thread
+from threading import Lock, Thread
 import time
 import os
 
@@ -43,48 +55,302 @@ password = app_config['datastore']['password']
 hostname = app_config['datastore']['hostname']
 port = app_config['datastore']['port']
 db = app_config['datastore']['db']
+sqlite_file = app_config['datastore']['sqlite_file']
 
-DB_ENGINE = create_engine(f'mysql+pymysql://{user}:{password}@{hostname}:{port}/{db}', pool_size=0, pool_recycle=-1, pool_pre_ping=True)
-# print(DB_ENGINE)
+# The consumer writes through the blocking engine, the read API through the bounded async pool
+if sqlite_file:
+    DB_ENGINE = create_engine(f'sqlite:///{sqlite_file}')
+    read_url = f'sqlite+aiosqlite:///{sqlite_file}'
+    logger.info(f"Using SQLite database {sqlite_file}")
+else:
+    DB_ENGINE = create_engine(f'mysql+pymysql://{user}:{password}@{hostname}:{port}/{db}', pool_size=0, pool_recycle=-1, pool_pre_ping=True)
+    read_url = f'mysql+aiomysql://{user}:{password}@{hostname}:{port}/{db}'
+    logger.info(f"connecting to DB. Hostname: {hostname}, Port: {port}")
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
-logger.info(f"connecting to DB. Hostname: {hostname}, Port: {port}")
+read_pool = ReadPool(read_url,
+                     size=app_config['datastore']['read_pool']['size'],
+                     timeout_sec=app_config['datastore']['read_pool']['timeout_sec'],
+                     recycle_sec=app_config['datastore']['read_pool']['recycle_sec'])
 
 # =============== Get
-def get_parking_status(start_timestamp, end_timestamp):
-    """ Gets parking status events between the specified timestamps """
-    session = DB_SESSION()
-    start_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    end_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    readings = session.query(ParkingStatus).filter(
-        and_(ParkingStatus.date_created >= start_datetime,
-             ParkingStatus.date_created < end_datetime))
+CACHE_CONFIG = app_config['datastore']['response_cache']
+CLOSED_CACHE_CONTROL = "public, max-age=31536000, immutable"
+response_cache = ResponseCache(CACHE_CONFIG['max_entries'], CACHE_CONFIG['max_bytes'])
 
-    results_list = [reading.to_dict() for reading in readings]
-    session.close()
+class NDJSONResponseBodyValidator(AbstractResponseBodyValidator):
+    """ Lets streamed NDJSON responses through unbuffered, every row comes from a validated insert """
 
-    logger.info(f"Query for parking status events between {start_timestamp} and {end_timestamp} returns {len(results_list)} results")
-    return results_list, 200
+    def wrap_send(self, send):
+        return send
 
-def get_payment_events(start_timestamp, end_timestamp):
-    """ Gets payment events between the specified timestamps """
-    session = DB_SESSION()
+async def stream_rows(conn, names, query):
+    """ Yields the query results as NDJSON, one chunk per server-side fetch, then returns the connection """
+    try:
+        result = await conn.stream(query.execution_options(yield_per=app_config['datastore']['yield_per']))
+        async for rows in result.partitions():
+            yield "".join(json.dumps(dict(zip(names, row)), cls=JSONEncoder) + "\n" for row in rows)
+    finally:
+        await conn.close()
+
+async def get_events(model, event_name, start_timestamp, end_timestamp, limit, after, stream, fields):
+    """ Gets one page, or a stream, of the requested fields of events between the specified timestamps
+
+    Rows are read with a Core select of only those columns and turned straight into dicts,
+    without building a mapped object per row.
+    """
     start_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
     end_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    readings = session.query(PaymentEvent).filter(
-        and_(PaymentEvent.date_created >= start_datetime,
-             PaymentEvent.date_created < end_datetime))
-
-    results_list = [reading.to_dict() for reading in readings]
-    session.close()
+    try:
+        cursor = decode_cursor(after) if after else None
+    except ValueError:
+        return {"message": f"Invalid cursor {after}"}, 400, {"Content-Type": "application/json"}
+
+    names, query = range_select(model, start_datetime, end_datetime, after=cursor, limit=limit, fields=fields)
+    if stream:
+        logger.info(f"Streaming {event_name} events between {start_timestamp} and {end_timestamp}")
+        response_cache.bypass()
+        # Check out before the response starts so an exhausted pool is still a 503
+        conn = await read_pool.checkout()
+        return StreamingResponse(stream_rows(conn, names, query), media_type="application/x-ndjson")
+
+    # Rows get date_created = the UTC time they are stored, so once the window has ended (give or
+    # take an in-flight batch) its response can never change
+    closed = end_datetime <= utc_now() - datetime.timedelta(seconds=CACHE_CONFIG['settle_sec'])
+    key = (model.__tablename__, start_datetime, end_datetime, limit, cursor, tuple(names))
+    entry = response_cache.get(key)
+
+    if entry is None:
+        async with read_pool.connect() as conn:
+            rows = (await conn.execute(query)).all()
+        # zip stops at the requested columns, dropping the trailing cursor columns
+        body = json.dumps([dict(zip(names, row)) for row in rows], cls=JSONEncoder).encode('utf-8')
+
+        headers = {"Cache-Control": CLOSED_CACHE_CONTROL if closed else "no-cache"}
+        if limit is not None and len(rows) == limit:
+            headers["X-Next-Cursor"] = encode_cursor(rows[-1].date_created, rows[-1].id)
+        entry = response_cache.put(key, body, headers, ttl=None if closed else CACHE_CONFIG['open_ttl_sec'])
+        logger.info(f"Query for {event_name} events between {start_timestamp} and {end_timestamp} returns {len(rows)} results")
+
+    headers = {**entry.headers, "ETag": entry.etag}
+    if entry.etag in request.headers.get("If-None-Match", ""):
+        response_cache.not_modified()
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+async def get_parking_status(start_timestamp, end_timestamp, limit=None, after=None, stream=False, fields=None):
+    """ Gets parking status events between the specified timestamps """
+    return await get_events(ParkingStatus, "parking status", start_timestamp, end_timestamp, limit, after, stream, fields)
 
-    logger.info(f"Query for payment events between {start_timestamp} and {end_timestamp} returns {len(results_list)} results")
-    return results_list, 200
+async def get_payment_events(start_timestamp, end_timestamp, limit=None, after=None, stream=False, fields=None):
+    """ Gets payment events between the specified timestamps """
+    return await get_events(PaymentEvent, "payment", start_timestamp, end_timestamp, limit, after, stream, fields)
 
 # =============== KAFKA
+CONSUMER_CONFIG = app_config['events']['consumer']
+
+batch_metrics = {
+    "batches": 0,
+    "rows": 0,
+    "skipped": 0,
+    "duplicates": 0,
+    "failed_flushes": 0,
+    "last_batch_size": 0,
+    "last_flush_ms": 0.0,
+    "rows_per_sec": 0.0,
+    "rebalances": 0,
+    "workers": {},
+    "committed_offsets": {}
+}
+metrics_lock = Lock()
+
+def decode_message(msg):
+    """ Decodes a Kafka message into its event type and table row, or None if it cannot be stored """
+    try:
+        event = json.loads(msg.value.decode('utf-8'))
+        payload = event["payload"]
+
+        if event["type"] == "parking_status":
+            return "parking_status", {
+                "meter_id": payload['meter_id'],
+                "device_id": payload['device_id'],
+                "status": payload['status'],
+                "spot_number": payload['spot_number'],
+                "timestamp": payload['timestamp'],
+                "trace_id": payload['trace_id']
+            }
+        elif event["type"] == "payment":
+            return "payment", {
+                "meter_id": payload['meter_id'],
+                "device_id": payload['device_id'],
+                "amount": payload['amount'],
+                "duration": payload['duration'],
+                "timestamp": payload['timestamp'],
+                "trace_id": payload['trace_id']
+            }
+        logger.error(f"Unknown event type at offset {msg.offset}: {event['type']}")
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Failed to decode message at offset {msg.offset}: {e}")
+    return None
+
+def store_batch(rows):
+    """ Bulk inserts a batch of parking status and payment rows in a single transaction
+
+    Rows whose trace_id is already in event_trace are dropped, and the trace_ids of the rest
+    are added to it in the same transaction. event_trace is never partitioned, so this holds
+    across batches even once trace_id is only unique per date_created in the event tables.
+    Two workers storing the same new event at once make one of the transactions fail on the
+    event_trace primary key, and its retry then finds the trace.
+
+    The event counters are bumped in the same transaction, so /stats never has to count rows.
+    Returns the number of rows of each type that were new.
+    """
+    inserted = {"parking_status": 0, "payment": 0}
+    date_created = utc_now()
+    session = DB_SESSION()
+    try:
+        trace_ids = [row["trace_id"] for event_rows in rows.values() for row in event_rows]
+        if trace_ids:
+            seen = set(session.execute(select(EventTrace.trace_id).where(EventTrace.trace_id.in_(trace_ids))).scalars())
+            rows = {event_type: [row for row in event_rows if row["trace_id"] not in seen]
+                    for event_type, event_rows in rows.items()}
+            new_trace_ids = [trace_id for trace_id in trace_ids if trace_id not in seen]
+            if new_trace_ids:
+                session.execute(insert(EventTrace.__table__).values(date_created=date_created),
+                                [{"trace_id": trace_id} for trace_id in new_trace_ids])
+        if rows["parking_status"]:
+            result = session.execute(insert_ignore(ParkingStatus.__table__, date_created), rows["parking_status"])
+            inserted["parking_status"] = result.rowcount
+        if rows["payment"]:
+            result = session.execute(insert_ignore(PaymentEvent.__table__, date_created), rows["payment"])
+            inserted["payment"] = result.rowcount
+        # Always in the same table order so concurrent workers lock the counter rows in the same order
+        for event_type, table in (("parking_status", ParkingStatus.__table__), ("payment", PaymentEvent.__table__)):
+            if inserted[event_type] > 0:
+                session.execute(update(EventCounter.__table__)
+                                .where(EventCounter.table_name == table.name)
+                                .values(num_events=EventCounter.num_events + inserted[event_type],
+                                        last_insert=date_created))
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return inserted
+
+def flush_batch(messages):
+    """ Stores a batch of messages, retrying until the database commit succeeds """
+    rows = {"parking_status": [], "payment": []}
+    trace_ids = set()
+    num_skipped = 0
+    for msg in messages:
+        decoded = decode_message(msg)
+        if decoded is None:
+            num_skipped += 1
+        elif decoded[1]["trace_id"] not in trace_ids:
+            # A message redelivered within the same batch is only written once
+            trace_ids.add(decoded[1]["trace_id"])
+            rows[decoded[0]].append(decoded[1])
+    num_rows = len(trace_ids)
+
+    start = time.time()
+    while True:
+        try:
+            inserted = store_batch(rows)
+            break
+        except Exception as e:
+            with metrics_lock:
+                batch_metrics["failed_flushes"] += 1
+            logger.error(f"Failed to store batch of {num_rows} events: {e} | Retrying in 5 seconds...")
+            time.sleep(5)
+    flush_sec = time.time() - start
+    num_inserted = inserted["parking_status"] + inserted["payment"]
+
+    with metrics_lock:
+        batch_metrics["batches"] += 1
+        batch_metrics["rows"] += num_inserted
+        batch_metrics["duplicates"] += len(messages) - num_skipped - num_inserted
+        batch_metrics["skipped"] += num_skipped
+        batch_metrics["last_batch_size"] = num_rows
+        batch_metrics["last_flush_ms"] = round(flush_sec * 1000, 3)
+        batch_metrics["rows_per_sec"] = round(num_rows / flush_sec, 1) if flush_sec > 0 else 0.0
+    logger.debug(f"Stored {inserted['parking_status']} parking_status and {inserted['payment']} payment events "
+                 f"({len(messages) - num_skipped - num_inserted} duplicates) in {flush_sec * 1000:.1f} ms")
+
+def commit_offsets(consumer, topic, next_offsets):
+    """ Commits the next offset to read for each partition """
+    try:
+        consumer.commit_offsets([(topic.partitions[partition_id], offset) for partition_id, offset in next_offsets.items()])
+    except Exception as e:
+        # The partition moved to another worker, which replays it from the last committed offset
+        logger.warning(f"Failed to commit offsets {next_offsets}: {e}")
+        return
+
+    with metrics_lock:
+        batch_metrics["committed_offsets"].update({str(p): o for p, o in next_offsets.items()})
+
+def consume_partitions(worker_id, topic):
+    """ Runs one member of the consumer group, writing the partitions it owns in micro-batches """
+    batch_size = CONSUMER_CONFIG['batch_size']
+    flush_sec = CONSUMER_CONFIG['flush_ms'] / 1000
+    commit_sec = CONSUMER_CONFIG['commit_interval_ms'] / 1000
+    consumer_group = str.encode(CONSUMER_CONFIG['group'])
+    owned = set()
+
+    def on_rebalance(consumer, old_offsets, new_offsets):
+        """ Records the partitions this worker owns after a rebalance """
+        owned.clear()
+        owned.update(partition_id for partition_id in new_offsets)
+        logger.info(f"Worker {worker_id} now owns partitions {sorted(owned)}, previously {sorted(old_offsets)}")
+        with metrics_lock:
+            batch_metrics["rebalances"] += 1
+            batch_metrics["workers"][str(worker_id)] = sorted(owned)
+
+    # consume() returns None once consumer_timeout_ms passes without a message, so partial batches still flush
+    if CONSUMER_CONFIG['mode'] == 'balanced':
+        consumer = topic.get_balanced_consumer(consumer_group=consumer_group, managed=True,
+                                               reset_offset_on_start=False, auto_offset_reset=OffsetType.LATEST,
+                                               auto_commit_enable=False, consumer_timeout_ms=CONSUMER_CONFIG['flush_ms'],
+                                               post_rebalance_callback=on_rebalance)
+    else:
+        consumer = topic.get_simple_consumer(consumer_group=consumer_group, reset_offset_on_start=False,
+                                             auto_offset_reset=OffsetType.LATEST, auto_commit_enable=False,
+                                             consumer_timeout_ms=CONSUMER_CONFIG['flush_ms'])
+        on_rebalance(consumer, {}, {partition_id: None for partition_id in topic.partitions})
+
+    messages = []
+    deadline = None
+    # Replayed messages are ignored on insert, so offsets only need committing every commit_interval_ms
+    pending_offsets = {}
+    last_commit = time.time()
+    while True:
+        msg = consumer.consume()
+        if msg is not None:
+            messages.append(msg)
+            if deadline is None:
+                deadline = time.time() + flush_sec
+
+        if messages and (len(messages) >= batch_size or time.time() >= deadline):
+            # Messages from partitions lost in a rebalance are replayed by their new owner
+            kept = [m for m in messages if m.partition_id in owned]
+            if len(kept) < len(messages):
+                logger.info(f"Worker {worker_id} dropped {len(messages) - len(kept)} messages from released partitions")
+            if kept:
+                flush_batch(kept)
+            for m in kept:
+                pending_offsets[m.partition_id] = max(pending_offsets.get(m.partition_id, 0), m.offset + 1)
+            messages = []
+            deadline = None
+
+        if pending_offsets and time.time() - last_commit >= commit_sec:
+            commit_offsets(consumer, topic, {p: o for p, o in pending_offsets.items() if p in owned})
+            pending_offsets = {}
+            last_commit = time.time()
+
 def process_messages():
-    """ Process event messages """
+    """ Connects to Kafka and starts the pool of consumer workers """
     hostname = "%s:%d" % (app_config["events"]["hostname"], app_config["events"]["port"])
 
     max_retries = 5
@@ -101,84 +367,109 @@ def process_messages():
             time.sleep(5)
             retry_count += 1        
 
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group', reset_offset_on_start=False, auto_offset_reset=OffsetType.LATEST)
-
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-
-        payload = msg["payload"]
-        # body = json.loads(payload)
-
-        logger.info(f'Connecting to DB. Hostname: {hostname}, Port: {port}')
-        session = DB_SESSION()
-        try:
-            if msg["type"] == "parking_status":
-
-                ps = ParkingStatus(
-                    meter_id=payload['meter_id'],
-                    device_id=payload['device_id'],
-                    status=payload['status'],
-                    spot_number=payload['spot_number'],
-                    timestamp=payload['timestamp'],
-                    trace_id=payload['trace_id']
-                )
-
-                session.add(ps)
-                session.commit()
-                session.close()
-                logger.debug(f'Stored event parking_status request with a trace id of {payload["trace_id"]}')
-
-            elif msg["type"] == "payment":
-                logger.info(f'Connecting to DB. Hostname: {hostname}, Port: {port}')
-                session = DB_SESSION()
-
-                pm = PaymentEvent(
-                    meter_id=payload['meter_id'],
-                    device_id=payload['device_id'],
-                    amount=payload['amount'],
-                    duration=payload['duration'],
-                    timestamp=payload['timestamp'],
-                    trace_id=payload['trace_id']
-                )
-
-                session.add(pm)
-                session.commit()
-                session.close()
-                logger.debug(f'Stored event payment request with a trace id of {payload["trace_id"]}')
-        except:
-            logger.error("Failed to store event" % msg) 
-        finally:
-            session.close()
-        consumer.commit_offsets()
+    # A simple consumer reads every partition, so only one worker can run in that mode
+    num_workers = CONSUMER_CONFIG['workers'] if CONSUMER_CONFIG['mode'] == 'balanced' else 1
+    workers = []
+    for worker_id in range(num_workers):
+        worker = Thread(target=consume_partitions, args=(worker_id, topic), name=f"consumer-{worker_id}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    logger.info(f"Started {num_workers} {CONSUMER_CONFIG['mode']} consumer workers")
+
+    for worker in workers:
+        worker.join()
+
+def get_metrics():
+    """ Gets the consumer batch metrics, the read pool occupancy and the response cache hit rate """
+    with metrics_lock:
+        metrics = dict(batch_metrics)
+        metrics["workers"] = dict(batch_metrics["workers"])
+        metrics["committed_offsets"] = dict(batch_metrics["committed_offsets"])
+    metrics["avg_batch_size"] = round(metrics["rows"] / metrics["batches"], 1) if metrics["batches"] else 0.0
+    metrics["read_pool"] = read_pool.stats()
+    metrics["response_cache"] = response_cache.stats()
+    return metrics, 200
 
 # =============== Stats
-def get_event_stats():
-    session = DB_SESSION()
-
+async def get_event_stats():
+    """ Gets the event totals and last insert times from the counters kept by the consumer """
     try:
-        num_parking_events = session.query(ParkingStatus).count()
-        num_payment_events = session.query(PaymentEvent).count()
+        async with read_pool.connect() as conn:
+            counters = {row.table_name: row for row in (await conn.execute(select(EventCounter.__table__))).all()}
+        parking = counters[ParkingStatus.__tablename__]
+        payment = counters[PaymentEvent.__tablename__]
 
         stats = {
-            "num_parking_events": num_parking_events,
-            "num_payment_events": num_payment_events
+            "num_parking_events": parking.num_events,
+            "num_payment_events": payment.num_events,
+            "last_parking_event": parking.last_insert,
+            "last_payment_event": payment.last_insert
         }
 
         logger.info(f"Stats retrieved: {stats}")
         return stats, 200
 
+    except PoolTimeout:
+        raise
+
     except Exception as e:
         logger.error(f"Error retrieving stats: {e}")
         return {"message": "Error retrieving stats"}, 500
 
-    finally:
-        session.close()
 
+async def get_event_aggregate(start_timestamp, end_timestamp, top=1, all_meters=False):
+    """ Gets the event counts, occupied reports, busiest meters and highest and total payment between the specified timestamps
+
+    The reductions run in the database, so the response stays a few hundred bytes whatever the window
+    holds, unless all_meters asks for the count of every meter active in it.
+    """
+    start_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
+    end_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
 
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True)
+    async with read_pool.connect() as conn:
+        num_parking_events = (await conn.execute(count_select(ParkingStatus, start_datetime, end_datetime))).scalar()
+        # status is true while the spot is free
+        num_occupied_events = (await conn.execute(count_select(ParkingStatus, start_datetime, end_datetime,
+                                                               ParkingStatus.status.is_(False)))).scalar()
+        top_meters = (await conn.execute(top_meters_select(ParkingStatus, start_datetime, end_datetime, None if all_meters else top))).all()
+        num_payment_events = (await conn.execute(count_select(PaymentEvent, start_datetime, end_datetime))).scalar()
+        max_amount, sum_amount = (await conn.execute(max_sum_select(PaymentEvent.amount, start_datetime, end_datetime))).one()
+
+    aggregate = {
+        "start_timestamp": start_timestamp,
+        "end_timestamp": end_timestamp,
+        "num_parking_events": num_parking_events,
+        "num_occupied_events": num_occupied_events,
+        "num_payment_events": num_payment_events,
+        # SQLite stand-ins created while the models declared meter_id a string still return strings
+        "top_meters": [{"meter_id": int(meter_id), "num_events": num_events} for meter_id, num_events in top_meters],
+        "max_amount": max_amount,
+        "sum_amount": sum_amount or 0
+    }
+
+    logger.info(f"Aggregate for events between {start_timestamp} and {end_timestamp}: "
+                f"{num_parking_events} parking status, {num_payment_events} payment")
+    return aggregate, 200
+
+
+def read_pool_exhausted(request, exc):
+    """ Turns a pool checkout timeout into a 503 so clients back off instead of piling on """
+    logger.warning(f"Rejected {request.url.path} with status 503, no read connection was free: {exc}")
+    return problem(503, "Service Unavailable", "All read connections are busy, retry shortly",
+                   headers={"Retry-After": str(app_config['datastore']['read_pool']['retry_after_sec'])})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """ Closes the read connections when the server shuts down """
+    yield
+    await read_pool.dispose()
+
+
+app = connexion.AsyncApp(__name__, specification_dir='', lifespan=lifespan)
+app.add_api("openapi.yml", base_path="/storage", strict_validation=True, validate_responses=True,
+            validator_map={"response": MediaTypeDict({**VALIDATOR_MAP["response"], "application/x-ndjson": NDJSONResponseBodyValidator})})
+app.add_error_handler(PoolTimeout, read_pool_exhausted)
 
 if __name__ == "__main__":
     t1 = Thread(target=process_messages)
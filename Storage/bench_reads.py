@@ -0,0 +1,101 @@
+""" Compares the ORM read path with the column-projected Core read path
+
+Usage:
+    python bench_reads.py                                   100000 rows, every field
+    python bench_reads.py --rows 500000 --fields meter_id,status
+
+Seeds parking_status in a throwaway SQLite database (or --url), then reads one window
+through each path, JSON encoding included, and reports rows/sec and the tracemalloc peak.
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+from connexion.jsonifier import JSONEncoder
+from sqlalchemy import and_, create_engine, insert
+from sqlalchemy.orm import sessionmaker
+from base import Base
+from parking_status import ParkingStatus
+from queries import range_select
+
+START = datetime.datetime(2024, 1, 1)
+END = datetime.datetime(2024, 1, 2)
+
+
+def seed(engine, num_rows):
+    """ Fills parking_status with num_rows events spread over the benchmark window """
+    Base.metadata.create_all(engine, tables=[ParkingStatus.__table__])
+    step = (END - START) / num_rows
+    with engine.begin() as conn:
+        for first in range(0, num_rows, 10000):
+            conn.execute(insert(ParkingStatus), [{
+                "meter_id": i % 500,
+                "device_id": str(uuid.uuid4()),
+                "status": bool(i % 2),
+                "spot_number": i % 40,
+                "timestamp": "2024-01-01T00:00:00Z",
+                "date_created": START + step * i,
+                "trace_id": str(uuid.uuid4())
+            } for i in range(first, min(first + 10000, num_rows))])
+
+
+def read_orm(engine, fields):
+    """ The original read path: a mapped object and a to_dict() per row """
+    session = sessionmaker(bind=engine)()
+    readings = session.query(ParkingStatus).filter(
+        and_(ParkingStatus.date_created >= START, ParkingStatus.date_created < END))
+    results_list = [reading.to_dict() for reading in readings]
+    if fields:
+        results_list = [{name: result[name] for name in fields} for result in results_list]
+    session.close()
+    return json.dumps(results_list, cls=JSONEncoder)
+
+
+def read_core(engine, fields):
+    """ The projected read path: a Core select of the requested columns, zipped straight into dicts """
+    names, query = range_select(ParkingStatus, START, END, fields=fields)
+    with engine.connect() as conn:
+        rows = conn.execute(query).all()
+    return json.dumps([dict(zip(names, row)) for row in rows], cls=JSONEncoder)
+
+
+def measure(read, engine, fields, num_rows):
+    """ Returns (rows/sec, peak bytes) for one read of the window """
+    tracemalloc.start()
+    start = time.perf_counter()
+    read(engine, fields)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return num_rows / elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Storage read path benchmark")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--fields", help="comma separated fields to project, every field when omitted")
+    parser.add_argument("--url", help="database URL, defaults to a temporary SQLite file")
+    args = parser.parse_args()
+
+    fields = args.fields.split(",") if args.fields else None
+    path = None
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        engine = create_engine(f"sqlite:///{path}")
+
+    seed(engine, args.rows)
+    # Warm the page cache so the first path measured is not penalised
+    read_core(engine, fields)
+
+    for name, read in (("orm", read_orm), ("core", read_core)):
+        rows_per_sec, peak = measure(read, engine, fields, args.rows)
+        print(f"{name:<5} {rows_per_sec:>12,.0f} rows/sec {peak / 1024 / 1024:>10.1f} MiB peak")
+
+    if path is not None:
+        os.remove(path)
@@ -11,6 +11,9 @@ db_cursor = db_conn.cursor()
 
 db_cursor.execute('DROP TABLE IF EXISTS parking_status')
 db_cursor.execute('DROP TABLE IF EXISTS payment_event')
+db_cursor.execute('DROP TABLE IF EXISTS event_counter')
+db_cursor.execute('DROP TABLE IF EXISTS event_trace')
+db_cursor.execute('DROP TABLE IF EXISTS schema_version')
 
 db_conn.commit()
 db_conn.close()
\ No newline at end of file
@@ -0,0 +1,25 @@
+from sqlalchemy import BigInteger, Column, DateTime, String
+from base import Base
+
+class EventCounter(Base):
+    """ Running row count of an event table """
+
+    __tablename__ = "event_counter"
+
+    table_name = Column(String(100), primary_key=True)
+    num_events = Column(BigInteger, nullable=False, default=0)
+    last_insert = Column(DateTime, nullable=True)
+
+    def __init__(self, table_name, num_events=0, last_insert=None):
+        """ Initializes the counter of an event table """
+        self.table_name = table_name
+        self.num_events = num_events
+        self.last_insert = last_insert
+
+    def to_dict(self):
+        """ Dictionary Representation of an event counter """
+        return {
+            'table_name': self.table_name,
+            'num_events': self.num_events,
+            'last_insert': self.last_insert
+        }
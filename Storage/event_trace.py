@@ -0,0 +1,22 @@
+from sqlalchemy import Column, DateTime, String
+from base import Base
+
+class EventTrace(Base):
+    """ trace_id of every stored event, the dedup key that stays unique when the event tables are partitioned """
+
+    __tablename__ = "event_trace"
+
+    trace_id = Column(String(100), primary_key=True)
+    date_created = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self, trace_id, date_created):
+        """ Initializes the trace of a stored event """
+        self.trace_id = trace_id
+        self.date_created = date_created
+
+    def to_dict(self):
+        """ Dictionary Representation of an event trace """
+        return {
+            'trace_id': self.trace_id,
+            'date_created': self.date_created
+        }
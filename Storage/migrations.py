@@ -0,0 +1,291 @@
+""" Versioned schema migrations for the Storage database
+
+Usage:
+    python migrations.py upgrade              apply pending migrations
+    python migrations.py status               list applied and pending migrations
+    python migrations.py partition            switch both tables to monthly RANGE partitions (MySQL only)
+    python migrations.py retention            add upcoming partitions and drop expired ones (MySQL only)
+    python migrations.py recount              reset the event counters from COUNT(*) of each table
+
+Pass --url to run against another database, e.g. --url sqlite:///events.db for a local stand-in.
+"""
+import argparse
+import datetime
+import logging
+import logging.config
+import os
+import yaml
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, create_engine, func, insert, inspect, select, text, update
+from sqlalchemy.sql.functions import now
+from base import Base
+from event_counter import EventCounter
+from event_trace import EventTrace
+from parking_status import ParkingStatus
+from payment import PaymentEvent
+
+logger = logging.getLogger('basicLogger')
+
+EVENT_TABLES = (ParkingStatus.__table__, PaymentEvent.__table__)
+
+version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", version_metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String(250), nullable=False),
+    Column("applied_at", DateTime, nullable=False, server_default=now())
+)
+
+
+def create_event_tables(conn):
+    """ Creates the event tables if they do not exist yet """
+    Base.metadata.create_all(conn, tables=list(EVENT_TABLES), checkfirst=True)
+
+
+def unique_trace_id(conn):
+    """ Makes trace_id unique, keeping the oldest copy of any duplicated event """
+    inspector = inspect(conn)
+    for table in EVENT_TABLES:
+        unique_columns = [u["column_names"] for u in inspector.get_unique_constraints(table.name)]
+        unique_columns += [i["column_names"] for i in inspector.get_indexes(table.name) if i["unique"]]
+        if ["trace_id"] in unique_columns:
+            continue
+        # The derived table lets MySQL delete from the table it is reading
+        conn.execute(text(f"""
+            DELETE FROM {table.name} WHERE id NOT IN (
+                SELECT id FROM (SELECT MIN(id) AS id FROM {table.name} GROUP BY trace_id) AS keep
+            )
+        """))
+        Index(f"ux_{table.name}_trace_id", table.c.trace_id, unique=True).create(conn)
+
+
+def range_query_indexes(conn):
+    """ Indexes date_created (with id as a tie breaker) and meter_id for range filters and lookups """
+    inspector = inspect(conn)
+    for table in EVENT_TABLES:
+        existing = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in (Index(f"ix_{table.name}_date_created", table.c.date_created, table.c.id),
+                      Index(f"ix_{table.name}_meter_id", table.c.meter_id)):
+            if index.name not in existing:
+                index.create(conn)
+
+
+def recount(conn):
+    """ Sets each event counter to the row count and newest date_created of its table
+
+    The counter row is locked first so consumer batches wait for the recount instead of being lost.
+    """
+    counters = EventCounter.__table__
+    for table in EVENT_TABLES:
+        exists = conn.execute(select(counters.c.table_name).where(counters.c.table_name == table.name)
+                              .with_for_update()).first()
+        num_events, last_insert = conn.execute(select(func.count(), func.max(table.c.date_created))).one()
+        if exists:
+            conn.execute(update(counters).where(counters.c.table_name == table.name)
+                         .values(num_events=num_events, last_insert=last_insert))
+        else:
+            conn.execute(counters.insert().values(table_name=table.name, num_events=num_events, last_insert=last_insert))
+
+
+def event_counters(conn):
+    """ Creates the event counters kept up to date by the consumer, seeded from the current tables """
+    EventCounter.__table__.create(conn, checkfirst=True)
+    recount(conn)
+
+
+def trace_id_table(conn):
+    """ Creates the trace_id dedup table checked by the consumer, seeded from the stored events """
+    traces = EventTrace.__table__
+    traces.create(conn, checkfirst=True)
+    for table in EVENT_TABLES:
+        conn.execute(insert(traces)
+                     .from_select(["trace_id", "date_created"],
+                                  select(table.c.trace_id, func.min(table.c.date_created)).group_by(table.c.trace_id))
+                     .prefix_with("IGNORE", dialect="mysql")
+                     .prefix_with("OR IGNORE", dialect="sqlite"))
+
+
+# Append new migrations to the end, never reorder or edit one that has shipped
+MIGRATIONS = [
+    (1, "Create parking_status and payment_event tables", create_event_tables),
+    (2, "Unique index on trace_id", unique_trace_id),
+    (3, "Indexes on date_created and meter_id", range_query_indexes),
+    (4, "Event counters", event_counters),
+    (5, "trace_id dedup table", trace_id_table),
+]
+
+
+def applied_versions(engine):
+    """ Returns the set of migration versions already applied """
+    with engine.begin() as conn:
+        version_metadata.create_all(conn, checkfirst=True)
+        return {row.version for row in conn.execute(schema_version.select())}
+
+
+def upgrade(engine):
+    """ Applies every pending migration in order, each in its own transaction """
+    applied = applied_versions(engine)
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {description}")
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(schema_version.insert().values(version=version, description=description))
+
+
+def status(engine):
+    """ Returns (version, description, applied) for every migration """
+    applied = applied_versions(engine)
+    return [(version, description, version in applied) for version, description, _ in MIGRATIONS]
+
+
+def month_start(date, months_ahead=0):
+    """ Returns the first day of the month months_ahead months after date """
+    month = date.year * 12 + date.month - 1 + months_ahead
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def partition_clause(first_month, months_ahead):
+    """ Builds the monthly partition list from first_month up to months_ahead months from now """
+    partitions = []
+    month = first_month
+    last = month_start(datetime.date.today(), months_ahead)
+    while month <= last:
+        upper = month_start(month, 1)
+        partitions.append(f"PARTITION p{month:%Y%m} VALUES LESS THAN (TO_DAYS('{upper}'))")
+        month = upper
+    partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+    return ", ".join(partitions)
+
+
+def partitions(conn, table_name):
+    """ Returns the partition names of a table in ascending order """
+    return [row[0] for row in conn.execute(text("""
+        SELECT partition_name FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = :table AND partition_name IS NOT NULL
+        ORDER BY partition_ordinal_position
+    """), {"table": table_name})]
+
+
+def trace_id_unique_key(conn, table_name):
+    """ Returns the name of the unique key on trace_id, which depends on how the table was created """
+    inspector = inspect(conn)
+    keys = inspector.get_unique_constraints(table_name) + [i for i in inspector.get_indexes(table_name) if i["unique"]]
+    return next(key["name"] for key in keys if key["column_names"] == ["trace_id"])
+
+
+def partition(engine, months_ahead):
+    """ Converts both event tables to monthly RANGE partitioning on date_created
+
+    MySQL requires every unique key of a partitioned table to contain the partitioning
+    column, so the primary key becomes (id, date_created) and trace_id is only unique
+    together with date_created. Redeliveries are still ignored, since the consumer checks
+    the unpartitioned event_trace table of migration 5, which partitioning requires.
+    """
+    if engine.dialect.name != "mysql":
+        logger.info(f"Partitioning is not supported on {engine.dialect.name}, skipping")
+        return
+    if 5 not in applied_versions(engine):
+        raise RuntimeError("Partitioning needs the trace_id dedup table, run upgrade first")
+
+    with engine.begin() as conn:
+        for table in EVENT_TABLES:
+            if partitions(conn, table.name):
+                logger.info(f"{table.name} is already partitioned")
+                continue
+            oldest = conn.execute(text(f"SELECT MIN(date_created) FROM {table.name}")).scalar()
+            first_month = month_start(oldest or datetime.date.today())
+            logger.info(f"Partitioning {table.name}, duplicates are caught by event_trace from now on")
+            conn.execute(text(f"ALTER TABLE {table.name} DROP INDEX {trace_id_unique_key(conn, table.name)}, "
+                              f"ADD UNIQUE INDEX ux_{table.name}_trace_id (trace_id, date_created), "
+                              f"DROP PRIMARY KEY, ADD PRIMARY KEY (id, date_created)"))
+            conn.execute(text(f"ALTER TABLE {table.name} PARTITION BY RANGE (TO_DAYS(date_created)) "
+                              f"({partition_clause(first_month, months_ahead)})"))
+
+
+def retention(engine, retention_months, months_ahead):
+    """ Adds partitions for the coming months and drops those older than retention_months
+
+    Dropping a partition removes a month of rows without scanning or deleting them one by one.
+    The dropped rows are taken off the event counters, and their traces are deleted from
+    event_trace, which is not partitioned. Returns the number of rows dropped from each table.
+    """
+    dropped = {}
+    if engine.dialect.name != "mysql":
+        logger.info(f"Partition retention is not supported on {engine.dialect.name}, skipping")
+        return dropped
+
+    today = datetime.date.today()
+    cutoff = f"p{month_start(today, -retention_months):%Y%m}"
+    with engine.begin() as conn:
+        for table in EVENT_TABLES:
+            names = partitions(conn, table.name)
+            if not names:
+                logger.info(f"{table.name} is not partitioned, skipping retention")
+                continue
+
+            monthly = [name for name in names if name != "pmax"]
+            next_month = month_start(datetime.datetime.strptime(monthly[-1][1:], "%Y%m").date(), 1) if monthly else month_start(today)
+            if next_month <= month_start(today, months_ahead):
+                conn.execute(text(f"ALTER TABLE {table.name} REORGANIZE PARTITION pmax INTO "
+                                  f"({partition_clause(next_month, months_ahead)})"))
+
+            expired = [name for name in monthly if name < cutoff]
+            dropped[table.name] = 0
+            if expired:
+                dropped[table.name] = conn.execute(text(
+                    f"SELECT COUNT(*) FROM {table.name} PARTITION ({', '.join(expired)})")).scalar()
+                conn.execute(text(f"ALTER TABLE {table.name} DROP PARTITION {', '.join(expired)}"))
+                counters = EventCounter.__table__
+                conn.execute(update(counters).where(counters.c.table_name == table.name)
+                             .values(num_events=counters.c.num_events - dropped[table.name]))
+                logger.info(f"Dropped partitions {expired} ({dropped[table.name]} rows) from {table.name}")
+
+        if any(dropped.values()):
+            traces = EventTrace.__table__
+            result = conn.execute(traces.delete().where(traces.c.date_created < month_start(today, -retention_months)))
+            logger.info(f"Deleted {result.rowcount} expired traces from event_trace")
+    return dropped
+
+
+def engine_from_config(app_config):
+    """ Creates an engine for the datastore in app_conf.yml """
+    datastore = app_config['datastore']
+    return create_engine(f"mysql+pymysql://{datastore['user']}:{datastore['password']}@"
+                         f"{datastore['hostname']}:{datastore['port']}/{datastore['db']}")
+
+
+if __name__ == "__main__":
+    if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+        app_conf_file = "/config/app_conf.yml"
+        log_conf_file = "/config/log_conf.yml"
+    else:
+        app_conf_file = "app_conf.yml"
+        log_conf_file = "log_conf.yml"
+
+    with open(app_conf_file, 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    with open(log_conf_file, 'r') as f2:
+        logging.config.dictConfig(yaml.safe_load(f2.read()))
+
+    parser = argparse.ArgumentParser(description="Storage schema migrations")
+    parser.add_argument("command", choices=["upgrade", "status", "partition", "retention", "recount"])
+    parser.add_argument("--url", help="database URL, defaults to the datastore in app_conf.yml")
+    args = parser.parse_args()
+
+    engine = create_engine(args.url) if args.url else engine_from_config(app_config)
+    partitioning = app_config['datastore']['partitioning']
+
+    if args.command == "upgrade":
+        upgrade(engine)
+    elif args.command == "status":
+        for version, description, applied in status(engine):
+            print(f"{version:>4}  {'applied' if applied else 'pending':<8} {description}")
+    elif args.command == "partition":
+        partition(engine, partitioning['months_ahead'])
+    elif args.command == "retention":
+        retention(engine, partitioning['retention_months'], partitioning['months_ahead'])
+    elif args.command == "recount":
+        with engine.begin() as conn:
+            recount(conn)
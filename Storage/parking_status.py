@@ -8,13 +8,13 @@ class ParkingStatus(Base):
     __tablename__ = "parking_status"
 
     id = Column(Integer, primary_key=True)
-    meter_id = Column(String, nullable=False)
-    device_id = Column(String, nullable=False)
+    meter_id = Column(Integer, nullable=False)
+    device_id = Column(String(250), nullable=False)
     status = Column(Boolean, nullable=False)
     spot_number = Column(Integer, nullable=False)
-    timestamp = Column(String, nullable=False)
+    timestamp = Column(String(100), nullable=False)
     date_created = Column(DateTime, nullable=False)
-    trace_id = Column(String, nullable=False)
+    trace_id = Column(String(100), nullable=False, unique=True)
 
     def __init__(self, meter_id, device_id, status, spot_number, timestamp, trace_id):
         """ Initializes a parking status update """
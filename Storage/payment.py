@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, Float, String, DateTime
 from sqlalchemy.sql.functions import now
 from base import Base
 
@@ -8,13 +8,13 @@ class PaymentEvent(Base):
     __tablename__ = "payment_event"
 
     id = Column(Integer, primary_key=True)
-    meter_id = Column(String(250), nullable=False)
+    meter_id = Column(Integer, nullable=False)
     device_id = Column(String(250), nullable=False)
-    amount = Column(Integer, nullable=False)
+    amount = Column(Float, nullable=False)
     duration = Column(Integer, nullable=False)
     timestamp = Column(String(100), nullable=False)
     date_created = Column(DateTime, nullable=False)
-    trace_id = Column(String, nullable=False)
+    trace_id = Column(String(100), nullable=False, unique=True)
 
 
     def __init__(self, meter_id, device_id, amount, duration, timestamp, trace_id):
@@ -0,0 +1,92 @@
+import base64
+import datetime
+from sqlalchemy import and_, desc, func, insert, or_, select
+
+
+def utc_now():
+    """ Returns the current UTC time as a naive datetime, the form date_created is stored and compared in
+
+    It is bound like the window and cursor parameters rather than left to the database's now(),
+    which SQLite stores as text without microseconds that never compares equal to a bound datetime.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def encode_cursor(date_created, id):
+    """ Encodes the (date_created, id) of the last returned row as an opaque cursor """
+    return base64.urlsafe_b64encode(f"{date_created.isoformat()}|{id}".encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Decodes a cursor back to (date_created, id), raising ValueError if it is malformed """
+    # Bad base64, bad text and a bad date or id all raise ValueError subclasses
+    date_created, id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split("|")
+    return datetime.datetime.fromisoformat(date_created), int(id)
+
+
+def insert_ignore(table, date_created):
+    """ Builds a bulk INSERT of rows created at date_created that skips rows whose trace_id is already stored """
+    return (insert(table)
+            .values(date_created=date_created)
+            .prefix_with("IGNORE", dialect="mysql")
+            .prefix_with("OR IGNORE", dialect="sqlite"))
+
+
+def in_window(table, start_datetime, end_datetime):
+    """ Filters a table to the rows created in [start_datetime, end_datetime) """
+    return and_(table.c.date_created >= start_datetime, table.c.date_created < end_datetime)
+
+
+def field_names(model, fields=None):
+    """ Returns the requested field names in column order, or every column when none are requested """
+    names = [column.name for column in model.__table__.columns]
+    if not fields:
+        return names
+    return [name for name in names if name in fields]
+
+
+def range_select(model, start_datetime, end_datetime, after=None, limit=None, fields=None):
+    """ Selects the requested columns of the rows created in [start_datetime, end_datetime) in (date_created, id) order
+
+    Rows come after the (date_created, id) cursor when one is given, which lets the
+    (date_created, id) index seek straight to the next page instead of skipping an OFFSET.
+    date_created and id are always selected after the requested columns so the last row
+    of a page can be turned into a cursor.
+    """
+    table = model.__table__
+    names = field_names(model, fields)
+    query = select(*[table.c[name] for name in names],
+                   *[table.c[name] for name in ("date_created", "id") if name not in names])
+    query = query.where(in_window(table, start_datetime, end_datetime))
+    if after is not None:
+        after_date_created, after_id = after
+        query = query.where(or_(table.c.date_created > after_date_created,
+                                and_(table.c.date_created == after_date_created, table.c.id > after_id)))
+    query = query.order_by(table.c.date_created, table.c.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return names, query
+
+
+def count_select(model, start_datetime, end_datetime, *conditions):
+    """ Counts the rows created in the window, optionally only those matching conditions """
+    table = model.__table__
+    return select(func.count()).select_from(table).where(in_window(table, start_datetime, end_datetime), *conditions)
+
+
+def top_meters_select(model, start_datetime, end_datetime, top):
+    """ Selects the top meters by number of rows created in the window, with their counts, every meter when top is None """
+    table = model.__table__
+    num_events = func.count().label("num_events")
+    query = (select(table.c.meter_id, num_events)
+             .where(in_window(table, start_datetime, end_datetime))
+             .group_by(table.c.meter_id)
+             .order_by(desc(num_events), table.c.meter_id))
+    if top is not None:
+        query = query.limit(top)
+    return query
+
+
+def max_sum_select(column, start_datetime, end_datetime):
+    """ Selects the largest value and the total of a column over the rows created in the window """
+    return select(func.max(column), func.sum(column)).where(in_window(column.table, start_datetime, end_datetime))
@@ -0,0 +1,82 @@
+import time
+from contextlib import asynccontextmanager
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+class ReadPool:
+    """ Bounded asyncio connection pool for the read API
+
+    At most size connections are ever open, so at most size queries run at once no matter
+    how many requests are in flight. The rest queue for a connection for up to timeout_sec,
+    after which sqlalchemy.exc.TimeoutError is raised. Every counter is only touched from
+    the event loop, so none of them need a lock.
+    """
+
+    def __init__(self, url, size, timeout_sec, recycle_sec):
+        """ Creates the async engine, connections are opened on first use """
+        # The pool class is explicit because aiosqlite would otherwise default to an unbounded NullPool
+        self.engine = create_async_engine(url,
+                                          poolclass=AsyncAdaptedQueuePool,
+                                          pool_size=size,
+                                          max_overflow=0,
+                                          pool_timeout=timeout_sec,
+                                          pool_recycle=recycle_sec,
+                                          pool_pre_ping=True)
+        self.size = size
+        self.waiting = 0
+        self.metrics = {
+            'checkouts': 0,
+            'checkout_timeouts': 0,
+            'max_waiting': 0,
+            'last_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'total_wait_ms': 0.0
+        }
+
+    async def checkout(self):
+        """ Returns a connection from the pool, recording how long the request queued for it
+
+        The caller must close the connection to return it to the pool.
+        """
+        self.waiting += 1
+        self.metrics['max_waiting'] = max(self.metrics['max_waiting'], self.waiting)
+        start = time.perf_counter()
+        try:
+            conn = await self.engine.connect()
+        except PoolTimeout:
+            self.metrics['checkout_timeouts'] += 1
+            raise
+        finally:
+            self.waiting -= 1
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        self.metrics['checkouts'] += 1
+        self.metrics['last_wait_ms'] = round(wait_ms, 3)
+        self.metrics['max_wait_ms'] = round(max(self.metrics['max_wait_ms'], wait_ms), 3)
+        self.metrics['total_wait_ms'] += wait_ms
+        return conn
+
+    @asynccontextmanager
+    async def connect(self):
+        """ Checks a connection out for the duration of the block """
+        conn = await self.checkout()
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+    def stats(self):
+        """ Returns the pool occupancy and checkout wait metrics """
+        stats = dict(self.metrics)
+        stats['size'] = self.size
+        stats['checked_out'] = self.engine.pool.checkedout()
+        stats['waiting'] = self.waiting
+        total_wait_ms = stats.pop('total_wait_ms')
+        stats['avg_wait_ms'] = round(total_wait_ms / stats['checkouts'], 3) if stats['checkouts'] else 0.0
+        return stats
+
+    async def dispose(self):
+        """ Closes every pooled connection """
+        await self.engine.dispose()
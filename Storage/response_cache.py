@@ -0,0 +1,87 @@
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class CachedResponse:
+    """ A serialized response body with its validator and expiry """
+
+    __slots__ = ("body", "etag", "headers", "expires")
+
+    def __init__(self, body, headers, expires):
+        """ Stores the body and derives a strong ETag from it """
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.headers = headers
+        self.expires = expires
+
+
+class ResponseCache:
+    """ Size bounded LRU of serialized range query responses
+
+    Closed windows never change, so their entries only leave through LRU eviction.
+    Open windows are kept for ttl seconds so a burst of polls costs one query.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        """ Initializes an empty cache holding at most max_entries bodies and max_bytes in total """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.lock = Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'not_modified': 0, 'bypassed': 0, 'evictions': 0}
+
+    def get(self, key):
+        """ Returns the live entry for key and marks it most recently used, or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.metrics['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.metrics['hits'] += 1
+            return entry
+
+    def put(self, key, body, headers, ttl=None):
+        """ Stores a body for key, for ttl seconds or until evicted when ttl is None, and returns its entry """
+        entry = CachedResponse(body, headers, None if ttl is None else time.monotonic() + ttl)
+        if len(body) > self.max_bytes:
+            self.bypass()
+            return entry
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.num_bytes += len(body)
+            while len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.metrics['evictions'] += 1
+        return entry
+
+    def _remove(self, key):
+        self.num_bytes -= len(self.entries.pop(key).body)
+
+    def bypass(self):
+        """ Counts a response that was served without going through the cache """
+        with self.lock:
+            self.metrics['bypassed'] += 1
+
+    def not_modified(self):
+        """ Counts a conditional request answered with 304 """
+        with self.lock:
+            self.metrics['not_modified'] += 1
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters and the current size """
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['entries'] = len(self.entries)
+            stats['bytes'] = self.num_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
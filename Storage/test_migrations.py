@@ -0,0 +1,42 @@
+""" Schema migrations against the MySQL dialect and a SQLite stand-in, run from Storage with python -m pytest """
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.dialects import mysql
+from sqlalchemy.schema import CreateTable
+from event_counter import EventCounter
+from event_trace import EventTrace
+from migrations import EVENT_TABLES, schema_version, status, upgrade
+
+
+def mysql_ddl(table):
+    """ Returns the CREATE TABLE of table as MySQL would receive it """
+    return str(CreateTable(table).compile(dialect=mysql.dialect()))
+
+
+def test_tables_compile_for_mysql_as_create_tables_created_them():
+    ddl = {table.name: mysql_ddl(table) for table in EVENT_TABLES + (EventCounter.__table__, EventTrace.__table__, schema_version)}
+
+    for name in ("parking_status", "payment_event"):
+        assert "trace_id VARCHAR(100) NOT NULL" in ddl[name]
+        assert "meter_id INTEGER NOT NULL" in ddl[name]
+        assert "device_id VARCHAR(250) NOT NULL" in ddl[name]
+        assert "timestamp VARCHAR(100) NOT NULL" in ddl[name]
+    assert "amount FLOAT NOT NULL" in ddl["payment_event"]
+    assert "duration INTEGER NOT NULL" in ddl["payment_event"]
+    assert "spot_number INTEGER NOT NULL" in ddl["parking_status"]
+    assert "trace_id VARCHAR(100) NOT NULL" in ddl["event_trace"]
+
+
+def test_upgrade_applies_every_migration_once(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'storage.db'}")
+    upgrade(engine)
+    upgrade(engine)
+
+    assert all(applied for _, _, applied in status(engine))
+    with engine.connect() as conn:
+        inspector = inspect(conn)
+        for table in EVENT_TABLES:
+            indexes = inspector.get_indexes(table.name)
+            assert {f"ix_{table.name}_date_created", f"ix_{table.name}_meter_id"} <= {index["name"] for index in indexes}
+            unique_columns = [u["column_names"] for u in inspector.get_unique_constraints(table.name)]
+            unique_columns += [index["column_names"] for index in indexes if index["unique"]]
+            assert ["trace_id"] in unique_columns
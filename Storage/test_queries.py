@@ -0,0 +1,54 @@
+""" Keyset paging against SQLite, run from Storage with python -m pytest """
+import datetime
+from sqlalchemy import create_engine
+from base import Base
+from parking_status import ParkingStatus
+from queries import decode_cursor, encode_cursor, insert_ignore, range_select, utc_now
+
+
+def store(engine, num_rows, date_created):
+    """ Inserts num_rows parking status rows in one statement, as store_batch does """
+    with engine.begin() as conn:
+        conn.execute(insert_ignore(ParkingStatus.__table__, date_created), [{
+            "meter_id": str(i),
+            "device_id": str(i),
+            "status": True,
+            "spot_number": i,
+            "timestamp": "2024-01-01T00:00:00Z",
+            "trace_id": f"trace-{i}"
+        } for i in range(num_rows)])
+
+
+def read_page(engine, start, end, limit, after=None):
+    """ Returns the rows of one page and the cursor the API would send with it """
+    _, query = range_select(ParkingStatus, start, end, after=decode_cursor(after) if after else None, limit=limit)
+    with engine.connect() as conn:
+        rows = conn.execute(query).all()
+    return rows, encode_cursor(rows[-1].date_created, rows[-1].id) if len(rows) == limit else None
+
+
+def test_pages_across_rows_created_in_the_same_second(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'storage.db'}")
+    Base.metadata.create_all(engine, tables=[ParkingStatus.__table__])
+    now = utc_now()
+    store(engine, 15, now)
+
+    start = now.replace(microsecond=0)
+    end = start + datetime.timedelta(seconds=1)
+    first, cursor = read_page(engine, start, end, limit=10)
+    second, next_cursor = read_page(engine, start, end, limit=10, after=cursor)
+
+    assert [row.id for row in first + second] == list(range(1, 16))
+    assert next_cursor is None
+
+
+def test_window_ends_before_its_end_second(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'storage.db'}")
+    Base.metadata.create_all(engine, tables=[ParkingStatus.__table__])
+    now = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    store(engine, 3, now)
+
+    rows, _ = read_page(engine, now - datetime.timedelta(seconds=1), now, limit=10)
+    assert rows == []
+    rows, _ = read_page(engine, now, now + datetime.timedelta(seconds=1), limit=10)
+    assert len(rows) == 3
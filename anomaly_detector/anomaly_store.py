@@ -0,0 +1,312 @@
+import bisect
+import datetime
+import json
+import os
+import time
+from collections import namedtuple
+from threading import Lock
+
+SEGMENT = "segment-{:06d}.ndjson"
+INDEX = "segment-{:06d}.idx"
+
+# Where one anomaly lives and the fields it can be looked up by
+Entry = namedtuple("Entry", "seq segment position length epoch event_type anomaly_type trace_id")
+
+
+def to_epoch(timestamp):
+    """ Converts a %Y-%m-%dT%H:%M:%SZ timestamp to seconds since the epoch, or None if it is not one """
+    try:
+        return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class AnomalyStore:
+    """ Append-only log of anomalies in NDJSON segments, indexed in memory
+
+    Each append writes its anomalies followed by a commit record holding the consumer
+    offsets they were found up to, in a single write that is synced before returning. On
+    load everything after the last commit of the active segment is cut off, so a crash
+    never leaves an anomaly without its offsets or the reverse. Appending costs the same
+    however much history there is.
+
+    A segment is sealed once it reaches segment_max_bytes, and a sidecar index of the
+    position, timestamp, event type, anomaly type and trace id of each record is written
+    next to it. Startup reads the sidecars instead of the sealed segments. Queries filter
+    the in-memory index and only read the records on the page they return.
+
+    compact() rewrites sealed segments without commit records, or anomalies already
+    stored for the same trace id and anomaly type, such as those imported from the
+    scheduled scans that saved every anomaly again on each run.
+    """
+
+    def __init__(self, directory, segment_max_bytes):
+        """ Loads the segments in directory, recovering the active one up to its last commit """
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.lock = Lock()
+        # Entries per segment, and all of them in seq order for queries
+        self.segments = {}
+        self.entries = []
+        self.by_trace_id = {}
+        self.offsets = {}
+        self.next_seq = 0
+        self.active = None
+        self.active_file = None
+        self.active_size = 0
+        self.last_compaction = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, template, segment):
+        return os.path.join(self.directory, template.format(segment))
+
+    def _load(self):
+        """ Reads the sidecar of every sealed segment and recovers the active one """
+        segments = sorted(int(name[len("segment-"):-len(".ndjson")]) for name in os.listdir(self.directory)
+                          if name.startswith("segment-") and name.endswith(".ndjson"))
+        for segment in segments[:-1]:
+            self.segments[segment], offsets = self._read_index(segment)
+            self.offsets = offsets or self.offsets
+
+        self.active = segments[-1] if segments else 1
+        entries, offsets, self.active_size = self._scan(self.active, committed_only=True)
+        self.segments[self.active] = entries
+        self.offsets = offsets or self.offsets
+        # Drop whatever followed the last commit, it was never acknowledged
+        with open(self._path(SEGMENT, self.active), 'ab') as f:
+            f.truncate(self.active_size)
+        self.active_file = open(self._path(SEGMENT, self.active), 'ab')
+        self._reindex()
+
+    def _reindex(self):
+        """ Rebuilds the flat and trace id indexes from the per-segment entries """
+        self.entries = [entry for segment in sorted(self.segments) for entry in self.segments[segment]]
+        self.by_trace_id = {}
+        for entry in self.entries:
+            self.by_trace_id.setdefault(entry.trace_id, []).append(entry)
+        if self.entries:
+            self.next_seq = max(self.next_seq, self.entries[-1].seq + 1)
+
+    def _scan(self, segment, committed_only):
+        """ Returns (entries, offsets of the last commit, bytes up to the last record kept) by reading a segment
+
+        With committed_only, records after the last commit are left out. A torn last line is always left out.
+        """
+        entries, pending, offsets = [], [], None
+        size = position = 0
+        path = self._path(SEGMENT, segment)
+        if not os.path.isfile(path):
+            return entries, offsets, size
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                if "commit" in record:
+                    entries.extend(pending)
+                    pending = []
+                    offsets = {int(partition_id): offset for partition_id, offset in record["commit"].items()}
+                    size = position + len(line)
+                else:
+                    pending.append(self._entry(record, segment, position, len(line)))
+                    if not committed_only:
+                        size = position + len(line)
+                position += len(line)
+        if not committed_only:
+            entries.extend(pending)
+        return entries, offsets, size
+
+    def _entry(self, record, segment, position, length):
+        """ Returns the index entry of a record """
+        anomaly = record["anomaly"]
+        return Entry(record["seq"], segment, position, length, to_epoch(anomaly.get("timestamp")),
+                     anomaly.get("event_type"), anomaly.get("anomaly_type"), anomaly.get("trace_id"))
+
+    def _read_index(self, segment):
+        """ Returns (entries, offsets at the end) of a sealed segment, rebuilding its sidecar if it is missing or stale """
+        path = self._path(INDEX, segment)
+        size = os.path.getsize(self._path(SEGMENT, segment))
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                header = json.loads(f.readline())
+                if header["size"] == size:
+                    offsets = {int(partition_id): offset for partition_id, offset in header["offsets"].items()}
+                    return [Entry(*fields) for fields in map(json.loads, f)], offsets
+
+        entries, offsets, _ = self._scan(segment, committed_only=False)
+        self._write_index(segment, entries, size, offsets or self.offsets)
+        return entries, offsets
+
+    def _write_index(self, segment, entries, size, offsets, compacted=False):
+        """ Atomically writes the sidecar index of a sealed segment """
+        path = self._path(INDEX, segment)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({"size": size, "offsets": {str(partition_id): offset for partition_id, offset in offsets.items()},
+                       "compacted": compacted}, f)
+            f.write("\n")
+            for entry in entries:
+                json.dump(list(entry), f)
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def append(self, anomalies, offsets):
+        """ Appends anomalies and the offsets they were found up to as one synced write
+
+        Only the consumer thread may append, compact or clear.
+        """
+        data = []
+        entries = []
+        position = self.active_size
+        for anomaly in anomalies:
+            record = {"seq": self.next_seq, "anomaly": anomaly}
+            line = (json.dumps(record) + "\n").encode('utf-8')
+            entries.append(self._entry(record, self.active, position, len(line)))
+            data.append(line)
+            position += len(line)
+            self.next_seq += 1
+        data.append((json.dumps({"commit": {str(partition_id): offset for partition_id, offset in offsets.items()}}) + "\n").encode('utf-8'))
+
+        self.active_file.write(b"".join(data))
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.active_size = self.active_file.tell()
+
+        with self.lock:
+            self.segments[self.active].extend(entries)
+            self.entries.extend(entries)
+            for entry in entries:
+                self.by_trace_id.setdefault(entry.trace_id, []).append(entry)
+            self.offsets = dict(offsets)
+
+        if self.active_size >= self.segment_max_bytes:
+            self._roll()
+
+    def _roll(self):
+        """ Seals the active segment and starts the next one """
+        self._write_index(self.active, self.segments[self.active], self.active_size, self.offsets)
+        self.active_file.close()
+        with self.lock:
+            self.active += 1
+            self.segments[self.active] = []
+        self.active_file = open(self._path(SEGMENT, self.active), 'ab')
+        self.active_size = 0
+
+    def compact(self):
+        """ Rewrites sealed segments without commit records or repeated anomalies, returning the records dropped """
+        seen = set()
+        dropped = 0
+        for segment in sorted(self.segments):
+            if segment == self.active:
+                break
+            with open(self._path(INDEX, segment), 'r') as f:
+                header = json.loads(f.readline())
+            entries = self.segments[segment]
+            keep = []
+            for entry in entries:
+                key = (entry.trace_id, entry.anomaly_type)
+                if key not in seen:
+                    seen.add(key)
+                    keep.append(entry)
+            if header["compacted"] and len(keep) == len(entries):
+                continue
+
+            dropped += len(entries) - len(keep)
+            path = self._path(SEGMENT, segment)
+            compacted = []
+            position = 0
+            with open(path, 'rb') as source, open(path + ".tmp", 'wb') as target:
+                for entry in keep:
+                    source.seek(entry.position)
+                    target.write(source.read(entry.length))
+                    compacted.append(entry._replace(position=position))
+                    position += entry.length
+                target.flush()
+                os.fsync(target.fileno())
+
+            with self.lock:
+                # A stale sidecar is rebuilt from the segment on load, so a crash between the two is harmless
+                os.replace(path + ".tmp", path)
+                self._write_index(segment, compacted, position, header["offsets"], compacted=True)
+                self.segments[segment] = compacted
+                self._reindex()
+
+        self.last_compaction = time.time()
+        return dropped
+
+    def clear(self):
+        """ Deletes every segment, leaving an empty store with no offsets """
+        self.active_file.close()
+        with self.lock:
+            for name in os.listdir(self.directory):
+                if name.startswith("segment-"):
+                    os.remove(os.path.join(self.directory, name))
+            self.segments = {}
+            self.offsets = {}
+            self.next_seq = 0
+            self.active = 1
+            self.active_size = 0
+            self.segments[self.active] = []
+            self._reindex()
+        self.active_file = open(self._path(SEGMENT, self.active), 'ab')
+
+    def query(self, event_type=None, anomaly_type=None, trace_id=None, start=None, end=None, limit=100, after=None):
+        """ Returns (anomalies, cursor of the next page or None), newest first
+
+        start and end bound the anomaly timestamps in seconds since the epoch, end exclusive.
+        after is the cursor returned with the previous page.
+        """
+        with self.lock:
+            candidates = self.by_trace_id.get(trace_id, []) if trace_id is not None else self.entries
+            last = len(candidates) if after is None else bisect.bisect_left(candidates, after, key=lambda entry: entry.seq)
+            page = []
+            for entry in reversed(candidates[:last]):
+                if event_type is not None and entry.event_type != event_type:
+                    continue
+                if anomaly_type is not None and entry.anomaly_type != anomaly_type:
+                    continue
+                if start is not None and (entry.epoch is None or entry.epoch < start):
+                    continue
+                if end is not None and (entry.epoch is None or entry.epoch >= end):
+                    continue
+                page.append(entry)
+                if len(page) > limit:
+                    break
+
+            cursor = page[limit - 1].seq if len(page) > limit else None
+            return self._read(page[:limit]), cursor
+
+    def _read(self, entries):
+        """ Reads the anomalies of entries from their segments, called with the lock held """
+        anomalies = []
+        files = {}
+        try:
+            for entry in entries:
+                if entry.segment not in files:
+                    files[entry.segment] = open(self._path(SEGMENT, entry.segment), 'rb')
+                f = files[entry.segment]
+                f.seek(entry.position)
+                anomalies.append(json.loads(f.read(entry.length))["anomaly"])
+        finally:
+            for f in files.values():
+                f.close()
+        return anomalies
+
+    def stats(self):
+        """ Returns the number of anomalies, segments and bytes on disk """
+        with self.lock:
+            num_anomalies = len(self.entries)
+            segments = list(self.segments)
+        return {
+            "anomalies": num_anomalies,
+            "segments": len(segments),
+            "bytes": sum(os.path.getsize(self._path(SEGMENT, segment)) for segment in segments
+                         if os.path.isfile(self._path(SEGMENT, segment))),
+            "last_compaction": None if self.last_compaction is None else
+            datetime.datetime.fromtimestamp(self.last_compaction, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        }
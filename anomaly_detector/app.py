@@ -3,13 +3,16 @@ import json
 import yaml
 import logging
 import logging.config
-from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from anomaly_store import AnomalyStore, to_epoch
+from kafka_pool import KafkaPool, KafkaUnavailable
+from rules import RuleEngine
 from threading import Thread
-from apscheduler.schedulers.background import BackgroundScheduler
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
+import argparse
 import os
-from connexion import NoContent
+import time
 
 # Load environment-specific configurations
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
@@ -30,76 +33,181 @@ with open(log_conf_file, 'r') as f2:
 
 logger = logging.getLogger('basicLogger')
 
-def save_anomalies(anomalies):
-    data_file = '/data/data.json'
-    if not os.path.exists('/data'):
-        os.makedirs('/data')
-    if not os.path.exists(data_file):
-        with open(data_file, 'w') as f:
-            json.dump([], f)
-
-    with open(data_file, 'r+') as f:
+# One Kafka client for the whole process, shared by the detector consumer and backfill
+pool_config = app_config['events']['pool']
+kafka = KafkaPool(f"{app_config['events']['hostname']}:{app_config['events']['port']}",
+                  app_config['events']['topic'],
+                  backoff_sec=pool_config['backoff_sec'],
+                  max_backoff_sec=pool_config['max_backoff_sec'],
+                  health_check_sec=pool_config['health_check_sec'])
+
+# Compiled once, a bad rule stops the detector at startup rather than on the first event
+rules = RuleEngine(app_config['rules'])
+ANOMALY_TYPES = rules.anomaly_types
+logger.info(f"Loaded {len(rules.rules)} anomaly rules: {', '.join(rule.name for rule in rules.rules)}")
+
+# Every anomaly found so far, with the offsets they were found up to
+store_config = app_config['datastore']
+store = AnomalyStore(store_config['directory'], store_config['segment_max_bytes'])
+
+def import_legacy_file():
+    """ Moves the anomalies of the JSON file written before the log into an empty store """
+    path = store_config['legacy_filename']
+    if store.entries or store.offsets or not os.path.isfile(path):
+        return
+    with open(path, 'r') as f:
         data = json.load(f)
-        data.extend(anomalies)
-        f.seek(0)
-        json.dump(data, f)
-
-def get_anomalies():
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config["events"]["topic"])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    # Files written by the scheduled scans are a bare list, without offsets
+    if isinstance(data, list):
+        data = {"anomalies": data, "offsets": {}}
+    store.append(data['anomalies'], {int(partition_id): offset for partition_id, offset in data['offsets'].items()})
+    logger.info(f"Imported {len(data['anomalies'])} anomalies from {path}")
+
+import_legacy_file()
+logger.info(f"Loaded {store.stats()['anomalies']} anomalies, consumed up to offsets {store.offsets}")
+
+def record_batch(messages, offsets):
+    """ Returns the anomalies in a batch of messages, advancing offsets past it """
+    found = rules.check(messages)
+    for msg in messages:
+        offsets[msg.partition_id] = msg.offset
+    if found:
+        logger.info(f"Anomalies detected: {found}")
+    return found
+
+def connect_detector_consumer(offsets):
+    """ Returns the events topic and a detector group consumer positioned after offsets, waiting for Kafka """
+    consumer_config = app_config['events']['consumer']
+
+    while True:
+        try:
+            topic = kafka.get_topic()
+            # Without stored offsets, resume from the group's or start with new events, see --backfill for history
+            consumer = topic.get_simple_consumer(consumer_group=str.encode(consumer_config['group']),
+                                                 auto_commit_enable=False,
+                                                 auto_offset_reset=OffsetType.LATEST,
+                                                 consumer_timeout_ms=consumer_config['flush_ms'])
+            if offsets:
+                # The stored offsets are the last consumed ones, which is what reset_offsets expects
+                consumer.reset_offsets([(topic.partitions[partition_id], offset)
+                                        for partition_id, offset in offsets.items()
+                                        if partition_id in topic.partitions])
+            return topic, consumer
+        except KafkaUnavailable:
+            # The client backs off between connects, so polling it often costs nothing
+            time.sleep(1)
+        except Exception as e:
+            kafka.invalidate(e)
+            time.sleep(1)
+
+def consume_events():
+    """ Checks every new event for anomalies in the detector's own consumer group
+
+    Each message is processed exactly once: the stored offsets, not the group's, decide where
+    consumption resumes, and each append writes them together with the anomalies they produced.
+    Batches with anomalies are appended straight away. Batches without any only move the offsets,
+    which are appended every snapshot_sec, since processing them again after a crash finds nothing.
+    Sealed segments are compacted every compact_sec. Malformed events are skipped, and any other
+    error drops the client and resumes from the stored offsets, so detection never stops silently.
+    """
+    consumer_config = app_config['events']['consumer']
+    last_compaction = time.time()
+
+    while True:
+        offsets = dict(store.offsets)
+        topic, consumer = connect_detector_consumer(offsets)
+        logger.info(f"Checking {app_config['events']['topic']} for anomalies from offsets {offsets or consumer.held_offsets}")
+        try:
+            unsaved = False
+            last_save = time.time()
+            while True:
+                messages = []
+                deadline = time.time() + consumer_config['flush_ms'] / 1000
+                while len(messages) < consumer_config['batch_size'] and time.time() < deadline:
+                    msg = consumer.consume(block=True)
+                    if msg is None:
+                        break
+                    messages.append(msg)
+
+                found = record_batch(messages, offsets) if messages else []
+                unsaved = unsaved or bool(messages)
+                if found or (unsaved and time.time() - last_save >= consumer_config['snapshot_sec']):
+                    store.append(found, offsets)
+                    # The group offsets follow the stored ones, for lag monitoring
+                    consumer.commit_offsets()
+                    unsaved = False
+                    last_save = time.time()
+
+                if time.time() - last_compaction >= store_config['compact_sec']:
+                    # Set first, so a compaction that fails waits a full interval before it is retried
+                    last_compaction = time.time()
+                    dropped = store.compact()
+                    logger.info(f"Compacted the anomaly log, dropping {dropped} repeated anomalies")
+        except Exception as e:
+            logger.exception(f"Checking {app_config['events']['topic']} failed, reconnecting: {e}")
+            kafka.invalidate(e)
+            try:
+                consumer.stop()
+            except Exception:
+                pass
+            time.sleep(1)
+
+def backfill():
+    """ Rebuilds the stored anomalies from every event on the topic, then returns
+
+    The store is replaced rather than added to, so history can be reprocessed any number of
+    times without duplicating anomalies. The detector resumes from the end of the backfill.
+    """
+    consumer_config = app_config['events']['consumer']
+    topic = kafka.get_topic()
+    end_offsets = {partition_id: response.offset[0] - 1 for partition_id, response in topic.latest_available_offsets().items()}
+    consumer = topic.get_simple_consumer(auto_offset_reset=OffsetType.EARLIEST,
+                                         reset_offset_on_start=True,
+                                         consumer_timeout_ms=consumer_config['flush_ms'])
+    logger.info(f"Backfilling anomalies up to offsets {end_offsets}")
+
+    store.clear()
+    offsets = {}
+    messages = []
+    for msg in consumer:
+        messages.append(msg)
+        if len(messages) == consumer_config['batch_size']:
+            store.append(record_batch(messages, offsets), offsets)
+            messages = []
+        if all(offsets.get(partition_id, -1) >= end for partition_id, end in end_offsets.items()):
+            break
+    store.append(record_batch(messages, offsets), offsets)
+    consumer.stop()
+
+    store.compact()
+    logger.info(f"Backfill found {store.stats()['anomalies']} anomalies up to offsets {offsets}")
+
+def get_anomalies(anomaly_type=None, event_type=None, trace_id=None, start_timestamp=None, end_timestamp=None,
+                  limit=100, after=None):
+    """ Gets one page of the stored anomalies matching the filters, newest first
+
+    Only the index is searched, and only the anomalies on the page are read from the log.
+    """
+    if anomaly_type is not None and anomaly_type not in ANOMALY_TYPES:
+        return {"message": f"Invalid anomaly type, expected one of {', '.join(ANOMALY_TYPES)}"}, 400
+    start = to_epoch(start_timestamp)
+    end = to_epoch(end_timestamp)
+    if (start_timestamp is not None and start is None) or (end_timestamp is not None and end is None):
+        return {"message": "Invalid timestamp, expected YYYY-MM-DDTHH:MM:SSZ"}, 400
+    try:
+        cursor = int(after) if after else None
+    except ValueError:
+        return {"message": f"Invalid cursor {after}"}, 400
 
-    logger.info("Processing events for anomalies.")
-    anomalies = []
+    page, next_cursor = store.query(event_type=event_type, anomaly_type=anomaly_type, trace_id=trace_id,
+                                    start=start, end=end, limit=limit, after=cursor)
+    logger.info(f"Returning {len(page)} anomalies")
+    headers = {"X-Next-Cursor": str(next_cursor)} if next_cursor is not None else {}
+    return page, 200, headers
 
-    try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            event_type = msg["type"]
-            payload = msg["payload"]
-
-            # Payment anomaly: amount > 100
-            if event_type == "payment" and payload["amount"] > 100:
-                anomalies.append({
-                    "event_id": str(payload["meter_id"]),
-                    "trace_id": payload["trace_id"],
-                    "event_type": event_type,
-                    "anomaly_type": "Too High",
-                    "description": f"Payment amount {payload['amount']} exceeded $100",
-                    "timestamp": payload["timestamp"]
-                })
-
-            # Parking anomaly: spots < 0
-            elif event_type == "parking_status" and payload["spot_number"] < 0:
-                anomalies.append({
-                    "event_id": str(payload["meter_id"]),
-                    "trace_id": payload["trace_id"],
-                    "event_type": event_type,
-                    "anomaly_type": "Too Low",
-                    "description": f"Parking spot {payload['spot_number']} is below zero",
-                    "timestamp": payload["timestamp"]
-                })
-
-        if anomalies:
-            logger.info(f"Anomalies detected: {anomalies}")
-            save_anomalies(anomalies)
-            logger.info(f"Saved {len(anomalies)} anomalies.")
-            return anomalies, 200  # Return anomalies with HTTP status 200
-        else:
-            logger.info("No anomalies detected.")
-            return NoContent, 204  # Return NoContent with HTTP status 204
-
-    except Exception as e:
-        logger.error(f"Error processing events: {e}")
-        return {"message": "Internal Server Error"}, 500  # Return error message with HTTP status 500
-
-# Scheduler initialization
-def init_scheduler():
-    sched = BackgroundScheduler(daemon=True)
-    sched.add_job(get_anomalies, 'interval', seconds=app_config['scheduler']['period_sec'])
-    sched.start()
+def get_metrics():
+    """Get Kafka Client and Anomaly Store Metrics"""
+    return {"kafka": kafka.stats(), "store": store.stats()}, 200
 
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("openapi.yml", base_path="/anomalies", strict_validation=True, validate_responses=True)
@@ -116,5 +224,13 @@ if "TARGET_ENV" not in os.environ or os.environ["TARGET_ENV"] != "test":
     )
 
 if __name__ == "__main__":
-    init_scheduler()
-    app.run(port=8120, host="0.0.0.0")
+    parser = argparse.ArgumentParser(description="Anomaly detector")
+    parser.add_argument("--backfill", action="store_true",
+                        help="rebuild the saved anomalies from the start of the topic and exit")
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill()
+    else:
+        Thread(target=consume_events, name='kafka-anomalies', daemon=True).start()
+        app.run(port=8120, host="0.0.0.0")
@@ -0,0 +1,129 @@
+import logging
+import random
+import time
+from threading import Lock
+from pykafka import KafkaClient
+
+logger = logging.getLogger('basicLogger')
+
+
+class KafkaUnavailable(Exception):
+    """ Raised when Kafka cannot be reached """
+
+
+def close_client(client):
+    """ Closes the broker connections and request threads of a client that is no longer used
+
+    pykafka has no close of its own, so a dropped client would otherwise keep a socket and
+    a request thread per broker open until the process exits.
+    """
+    for broker in client.brokers.values():
+        try:
+            for connection in (broker._connection, broker._offsets_channel_connection):
+                if connection is not None:
+                    connection.disconnect()
+            # Queued requests fail fast on the closed sockets, so stopping does not wait on the broker
+            for handler in (broker._req_handler, broker._offsets_channel_req_handler):
+                if handler is not None:
+                    handler.stop()
+        except Exception as e:
+            logger.warning(f"Failed to close the connection to Kafka broker {broker.host}:{broker.port}: {e}")
+
+
+class KafkaPool:
+    """ One long-lived Kafka client per process, reconnected with backoff after a failure
+
+    The client connects on first use, so a service starts even while Kafka is down. A
+    failed connect is retried no sooner than a full-jitter backoff that doubles up to
+    max_backoff_sec, and callers get KafkaUnavailable in the meantime instead of queuing
+    on a dead broker. Cluster metadata is refreshed at most every health_check_sec, and a
+    failed refresh or a caller reporting an I/O error drops the client, closing its broker
+    connections, so the next use reconnects.
+    """
+
+    def __init__(self, hosts, topic, backoff_sec, max_backoff_sec, health_check_sec):
+        """ Initializes the client settings, nothing connects until the topic is first needed """
+        self.hosts = hosts
+        self.topic_name = topic
+        self.backoff_sec = backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.health_check_sec = health_check_sec
+        self.lock = Lock()
+        self.client = None
+        self.topic = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self.checked_at = 0.0
+        self.metrics = {
+            'connects': 0,
+            'connect_failures': 0,
+            'disconnects': 0,
+            'last_connect_ms': 0.0,
+            'max_connect_ms': 0.0,
+            'health_check_failures': 0
+        }
+
+    def get_topic(self):
+        """ Returns the topic, connecting if there is no live client
+
+        Raises KafkaUnavailable while Kafka is unreachable.
+        """
+        with self.lock:
+            if self.topic is not None and time.monotonic() - self.checked_at >= self.health_check_sec:
+                self._check_health()
+            if self.topic is not None:
+                return self.topic
+            if time.monotonic() < self.retry_at:
+                raise KafkaUnavailable(f"Reconnecting to Kafka in {self.retry_at - time.monotonic():.1f} seconds")
+
+            start = time.perf_counter()
+            try:
+                client = KafkaClient(hosts=self.hosts)
+                topic = client.topics[str.encode(self.topic_name)]
+            except Exception as e:
+                self.failures += 1
+                self.metrics['connect_failures'] += 1
+                self.retry_at = time.monotonic() + random.uniform(0, min(self.backoff_sec * 2 ** self.failures, self.max_backoff_sec))
+                logger.error(f"Failed to connect to Kafka: {e} | Attempt {self.failures}")
+                raise KafkaUnavailable(f"Failed to connect to Kafka: {e}") from e
+
+            connect_ms = (time.perf_counter() - start) * 1000
+            self.metrics['connects'] += 1
+            self.metrics['last_connect_ms'] = round(connect_ms, 1)
+            self.metrics['max_connect_ms'] = round(max(self.metrics['max_connect_ms'], connect_ms), 1)
+            self.client, self.topic = client, topic
+            self.failures = 0
+            self.checked_at = time.monotonic()
+            logger.info(f"Connected to Kafka at {self.hosts} in {connect_ms:.1f} ms")
+            return topic
+
+    def _check_health(self):
+        """ Refreshes the cluster metadata, dropping the client if no broker answers """
+        self.checked_at = time.monotonic()
+        try:
+            self.client.update_cluster()
+        except Exception as e:
+            self.metrics['health_check_failures'] += 1
+            logger.warning(f"Kafka health check failed: {e}")
+            self._drop()
+
+    def _drop(self):
+        """ Closes and forgets the client, the next get_topic reconnects """
+        close_client(self.client)
+        self.client = self.topic = None
+        self.metrics['disconnects'] += 1
+
+    def invalidate(self, error):
+        """ Reports an I/O error seen through the client, so the next use reconnects """
+        logger.warning(f"Dropping the Kafka client after an error: {error}")
+        with self.lock:
+            if self.client is not None:
+                self._drop()
+
+    def stats(self):
+        """ Returns connection and health check metrics """
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['connected'] = self.client is not None
+            stats['active_connections'] = sum(broker.connected for broker in self.client.brokers.values()) if self.client else 0
+        return stats
@@ -0,0 +1,206 @@
+import json
+import logging
+import math
+import operator
+import string
+from collections import namedtuple
+import numpy as np
+
+logger = logging.getLogger('basicLogger')
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne
+}
+SEVERITIES = ("info", "warning", "critical")
+# Payload fields every anomaly is built from, beyond the ones the rules read
+REQUIRED_FIELDS = ("meter_id", "trace_id", "timestamp")
+# Columns only pay off with at least this many rules for an event type and checks (events times rules)
+# in a batch, below either one pass over the events is faster
+VECTOR_MIN_RULES = 8
+VECTOR_MIN_CHECKS = 8000
+# What to_number takes for a number, compared by class since JSON decodes to no subclasses
+NUMBERS = frozenset((int, float, bool))
+
+Rule = namedtuple("Rule", "name event_type field operator threshold anomaly_type severity description")
+
+
+def compile_rule(config):
+    """ Returns the Rule declared by one entry of the rules config, raising ValueError if it is invalid """
+    if config["operator"] not in OPERATORS:
+        raise ValueError(f"Rule {config['name']}: unknown operator {config['operator']}, expected one of {', '.join(OPERATORS)}")
+    if config["severity"] not in SEVERITIES:
+        raise ValueError(f"Rule {config['name']}: unknown severity {config['severity']}, expected one of {', '.join(SEVERITIES)}")
+    return Rule(config["name"], config["event_type"], config["field"], OPERATORS[config["operator"]],
+                float(config["threshold"]), config["anomaly_type"], config["severity"], config["description"])
+
+
+def decode(value):
+    """ Returns (event type, payload) of an encoded event, raising ValueError if it cannot be checked """
+    event = json.loads(value.decode('utf-8'))
+    if not isinstance(event, dict) or not isinstance(event.get("type"), str) or not isinstance(event.get("payload"), dict):
+        raise ValueError("Event has no type or payload")
+    payload = event["payload"]
+    missing = [field for field in REQUIRED_FIELDS if field not in payload]
+    if missing:
+        raise ValueError(f"Payload has no {', '.join(missing)}")
+    return event["type"], payload
+
+
+def to_number(value):
+    """ Returns value as a float, or nan if it is not a number """
+    return float(value) if isinstance(value, (int, float)) else np.nan
+
+
+def column(payloads, field):
+    """ Returns the field of every payload as a float array, nan where it is missing or not a number """
+    values = [payload.get(field, np.nan) for payload in payloads]
+    try:
+        array = np.array(values)
+    except ValueError:
+        # Lists of different lengths
+        array = None
+    if array is not None and array.ndim == 1 and array.dtype.kind in "biuf":
+        # The common case, all numbers, without a Python call per value
+        return array.astype(np.float64)
+    # Strings, None or nested values, which must not be parsed as numbers
+    return np.fromiter(map(to_number, values), dtype=np.float64, count=len(values))
+
+
+def anomaly(rule, payload):
+    """ Returns the anomaly of an event whose payload matched rule """
+    return {
+        "event_id": str(payload["meter_id"]),
+        "trace_id": str(payload["trace_id"]),
+        "event_type": rule.event_type,
+        "anomaly_type": rule.anomaly_type,
+        "severity": rule.severity,
+        "description": rule.description.format(value=payload[rule.field], threshold=rule.threshold),
+        "timestamp": str(payload["timestamp"])
+    }
+
+
+def description_source(rule):
+    """ Returns an f-string rendering the description of rule from a local value, as anomaly formats it
+
+    Raises ValueError if the description uses anything but {value} and {threshold}.
+    """
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(rule.description):
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        if field is None:
+            continue
+        if field not in ("value", "threshold") or "{" in spec:
+            raise ValueError(f"Rule {rule.name}: description may only use {{value}} and {{threshold}}")
+        expression = "value" if field == "value" else repr(rule.threshold)
+        parts.append("{" + expression + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}")
+    return "f" + repr("".join(parts))
+
+
+def compile_checks(by_event_type, checked):
+    """ Returns a function finding the anomalies among event types and payloads one event at a time
+
+    The rules are written into its source as literal comparisons and anomalies, so an event costs
+    what the hard-coded branches they replace did. Unless checked, fields are read without a type
+    check, and a missing or non-numeric value raises KeyError or TypeError rather than never matching.
+    """
+    symbols = {compare: symbol for symbol, compare in OPERATORS.items()}
+    lines = ["def find(event_types, payloads):",
+             "    found = []",
+             "    append = found.append",
+             "    for event_type, payload in zip(event_types, payloads):"]
+    keyword = "if"
+    for event_type, rules in by_event_type.items():
+        lines.append(f"        {keyword} event_type == {event_type!r}:")
+        for _, rule in rules:
+            comparison = f"value {symbols[rule.operator]} {rule.threshold!r}"
+            # != holds for a string or nan, so it is checked even on the fast path
+            if checked or rule.operator is operator.ne:
+                lines.append(f"            value = payload.get({rule.field!r})")
+                guard = " and value == value" if rule.operator is operator.ne else ""
+                lines.append(f"            if value.__class__ in NUMBERS and {comparison}{guard}:")
+            else:
+                lines.append(f"            value = payload[{rule.field!r}]")
+                lines.append(f"            if {comparison}:")
+            lines.append("                append({'event_id': str(payload['meter_id']), 'trace_id': str(payload['trace_id']), "
+                         f"'event_type': {rule.event_type!r}, 'anomaly_type': {rule.anomaly_type!r}, 'severity': {rule.severity!r}, "
+                         f"'description': {description_source(rule)}, 'timestamp': str(payload['timestamp'])}})")
+        keyword = "elif"
+    if not by_event_type:
+        lines.append("        pass")
+    lines.append("    return found")
+    namespace = {"NUMBERS": NUMBERS, "inf": math.inf, "nan": math.nan}
+    exec("\n".join(lines), namespace)
+    return namespace["find"]
+
+
+class RuleEngine:
+    """ Threshold rules compiled once and evaluated over a batch of events at a time
+
+    Each event type of a batch is gathered into one float column per field its rules
+    read, and each rule is a single comparison over the column, so the cost per event
+    is a few array operations rather than a Python branch per rule. Building the columns
+    costs more than it saves for a few rules or a small batch, which go through one pass
+    over the events compiled from the rules instead. Values that are missing or not
+    numbers never match.
+    """
+
+    def __init__(self, rules_config):
+        """ Compiles the rules config, raising ValueError on an unknown operator or severity or a bad description """
+        self.rules = [compile_rule(config) for config in rules_config]
+        self.by_event_type = {}
+        for position, rule in enumerate(self.rules):
+            self.by_event_type.setdefault(rule.event_type, []).append((position, rule))
+        # In config order, without repeats
+        self.anomaly_types = tuple(dict.fromkeys(rule.anomaly_type for rule in self.rules))
+        self.max_rules = max(map(len, self.by_event_type.values()), default=0)
+        self.find_fast = compile_checks(self.by_event_type, checked=False)
+        self.find_checked = compile_checks(self.by_event_type, checked=True)
+
+    def find(self, event_types, payloads):
+        """ Returns the anomalies among decoded events, in event then rule order """
+        if self.max_rules >= VECTOR_MIN_RULES and len(event_types) * self.max_rules >= VECTOR_MIN_CHECKS:
+            return [anomaly(rule, payloads[i]) for i, rule in self.evaluate(event_types, payloads)]
+        try:
+            # The common case, every field a rule reads present and a number
+            return self.find_fast(event_types, payloads)
+        except (KeyError, TypeError):
+            return self.find_checked(event_types, payloads)
+
+    def evaluate(self, event_types, payloads):
+        """ Returns [(index, rule)] for every rule an event matches, in event then rule order """
+        types = np.array(event_types, dtype=object)
+        matches = []
+        for event_type, rules in self.by_event_type.items():
+            indexes = np.flatnonzero(types == event_type)
+            if not len(indexes):
+                continue
+            selected = list(map(payloads.__getitem__, indexes.tolist()))
+            columns = {}
+            for position, rule in rules:
+                if rule.field not in columns:
+                    columns[rule.field] = column(selected, rule.field)
+                values = columns[rule.field]
+                mask = rule.operator(values, rule.threshold) & ~np.isnan(values)
+                matches.extend((int(i), position) for i in indexes[mask])
+
+        matches.sort()
+        return [(i, self.rules[position]) for i, position in matches]
+
+    def check(self, messages):
+        """ Returns the anomalies found in a batch of Kafka messages, skipping any that cannot be decoded """
+        event_types = []
+        payloads = []
+        for msg in messages:
+            try:
+                event_type, payload = decode(msg.value)
+            except ValueError as e:
+                logger.error(f"Skipping malformed event at offset {msg.offset}: {e}")
+                continue
+            event_types.append(event_type)
+            payloads.append(payload)
+        return self.find(event_types, payloads)
@@ -0,0 +1,89 @@
+""" Anomaly rules over batches of Kafka messages, run from anomaly_detector with python -m pytest """
+import json
+from collections import namedtuple
+import pytest
+from rules import RuleEngine, anomaly
+
+Message = namedtuple("Message", "partition_id offset value")
+
+RULES = [{
+    "name": "payment_too_high",
+    "event_type": "payment",
+    "field": "amount",
+    "operator": ">",
+    "threshold": 100,
+    "anomaly_type": "Too High",
+    "severity": "warning",
+    "description": "Payment amount {value} exceeded $100"
+}]
+
+
+def message(offset, event):
+    """ Returns a message holding event encoded the way the Receiver sends it """
+    return Message(0, offset, event if isinstance(event, bytes) else json.dumps(event).encode('utf-8'))
+
+
+def payment(meter_id, amount, **fields):
+    """ Returns a payment event, fields replacing or with None removing payload fields """
+    payload = {"meter_id": meter_id, "amount": amount, "trace_id": f"trace-{meter_id}",
+               "timestamp": "2024-01-01T00:00:00Z"}
+    payload.update(fields)
+    return {"type": "payment", "payload": {key: value for key, value in payload.items() if value is not None}}
+
+
+def test_skips_malformed_events_and_checks_the_rest():
+    engine = RuleEngine(RULES)
+    messages = [
+        message(0, payment(1, 150)),
+        message(1, b"not json"),
+        message(2, payment(2, 150, trace_id=None)),
+        message(3, payment(3, 150, timestamp=None)),
+        message(4, {"type": "payment", "payload": "150"}),
+        message(5, {"payload": payment(5, 150)["payload"]}),
+        message(6, payment(6, "150")),
+        message(7, payment(7, 5)),
+        message(8, payment(8, 250))
+    ]
+
+    found = engine.check(messages)
+
+    assert [anomaly["event_id"] for anomaly in found] == ["1", "8"]
+    assert found[1] == {"event_id": "8", "trace_id": "trace-8", "event_type": "payment",
+                        "anomaly_type": "Too High", "severity": "warning",
+                        "description": "Payment amount 250 exceeded $100",
+                        "timestamp": "2024-01-01T00:00:00Z"}
+
+
+def test_batch_of_only_malformed_events_finds_nothing():
+    engine = RuleEngine(RULES)
+    assert engine.check([message(0, b"\xff"), message(1, payment(1, 150, trace_id=None))]) == []
+
+
+def test_compiled_checks_find_what_the_columns_find():
+    engine = RuleEngine(RULES + [
+        dict(RULES[0], name="payment_refund", operator="<=", threshold=0, description="Refund of {value:.2f}"),
+        dict(RULES[0], name="payment_not_hour", field="duration", operator="!=", threshold=60,
+             description="{value!r} minutes is not {threshold}"),
+        dict(RULES[0], name="spot_negative", event_type="parking_status", field="spot_number", operator="<",
+             threshold=0, description="Parking spot {value} is below zero")
+    ])
+    event_types = ["payment", "parking_status", "payment", "payment", "other", "payment", "parking_status", "payment"]
+    payloads = [{"amount": 150, "duration": 60}, {"spot_number": -1}, {"amount": "150", "duration": float("nan")},
+                {"amount": -5.5, "duration": 30}, {"amount": 500}, {"amount": None, "duration": True},
+                {"spot_number": 3}, {"amount": [150]}]
+    for i, payload in enumerate(payloads):
+        payload.update(meter_id=i, trace_id=f"trace-{i}", timestamp="2024-01-01T00:00:00Z")
+
+    found = [anomaly(rule, payloads[i]) for i, rule in engine.evaluate(event_types, payloads)]
+
+    assert engine.find(event_types, payloads) == engine.find_checked(event_types, payloads) == found
+    assert [(item["event_id"], item["description"]) for item in found] == [
+        ("0", "Payment amount 150 exceeded $100"), ("1", "Parking spot -1 is below zero"),
+        ("3", "Refund of -5.50"), ("3", "30 minutes is not 60.0"), ("5", "True minutes is not 60.0")]
+    clean = [0, 1, 3, 6]
+    assert engine.find_fast([event_types[i] for i in clean], [payloads[i] for i in clean]) == found[:4]
+
+
+def test_description_may_only_use_value_and_threshold():
+    with pytest.raises(ValueError):
+        RuleEngine([dict(RULES[0], description="Payment {payload} exceeded $100")])
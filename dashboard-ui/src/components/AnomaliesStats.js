@@ -8,15 +8,16 @@ export default function AnomaliesStats() {
     const [error, setError] = useState(null);
 
     const getAnomalies = () => {
-        fetch(`http://kafka-acit3855.westus.cloudapp.azure.com/anomalies/anomalies`)
-            .then(res => res.json())
-            .then((result) => {
+        const getLatest = (eventType) =>
+            fetch(`http://kafka-acit3855.westus.cloudapp.azure.com/anomalies/anomalies?event_type=${eventType}&limit=1`)
+                .then(res => res.json());
+        // Anomalies come newest first, so a page of one is the latest of each event type
+        Promise.all([getLatest("parking_status"), getLatest("payment")])
+            .then(([parking, payment]) => {
                 console.log("Received Anomalies");
-                console.log(result);
-                const latestParking = result.filter(anomaly => anomaly.event_type === "parking_status").pop();
-                const latestPayment = result.filter(anomaly => anomaly.event_type === "payment").pop();
-                setLatestParkingAnomaly(latestParking);
-                setLatestPaymentAnomaly(latestPayment);
+                console.log(parking, payment);
+                setLatestParkingAnomaly(parking[0]);
+                setLatestPaymentAnomaly(payment[0]);
                 setIsLoaded(true);
             }, (error) => {
                 setError(error);